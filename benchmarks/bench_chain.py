@@ -0,0 +1,54 @@
+'''Benchmarks of the Metropolis-Hastings search over graphs: one acceptance decision of min_epidemic_choice_fx and
+whole network_mc chains. Throughput is reported in MCMC steps per second.'''
+
+import numpy as np
+import epidemic_network_modelling.epidemic_network_modelling as em
+from .common import SIZES, MEAN_DEGREES, degree_sequence, contact_graph, throughput
+
+
+class MinEpidemicChoiceFx(object):
+    params = (SIZES, MEAN_DEGREES)
+    param_names = ['num_people', 'mean_degree']
+    timeout = 600
+    num_its_sri_mc = 50
+    n_replicates = 20
+
+    def setup(self, num_people, mean_degree):
+        self.current = contact_graph(num_people, mean_degree)
+        self.candidate = em.swap_function(self.current, rng = 0)
+        self.ages = np.full(num_people, 30)
+
+    def run(self):
+        em.min_epidemic_choice_fx(self.candidate, self.current, self.ages, .3, .2, .8, self.num_its_sri_mc, rng = 0, n_replicates = self.n_replicates)
+
+    def time_min_epidemic_choice_fx(self, num_people, mean_degree):
+        self.run()
+
+    def peakmem_min_epidemic_choice_fx(self, num_people, mean_degree):
+        self.run()
+
+
+class NetworkMc(object):
+    #the likely networks are returned as CSR matrices, as dense ones would need tens of GB at 100k people
+    params = (SIZES, MEAN_DEGREES)
+    param_names = ['num_people', 'mean_degree']
+    timeout = 900
+    num_its_network_mc = 10
+    num_its_sri_mc = 50
+
+    def setup(self, num_people, mean_degree):
+        self.degrees = degree_sequence(num_people, mean_degree)
+        self.ages = np.full(num_people, 30)
+
+    def run(self):
+        em.network_mc(self.degrees, self.ages, em.min_epidemic_choice_fx, .3, .2, .8, .1, num_its_network_mc = self.num_its_network_mc, num_its_sri_mc = self.num_its_sri_mc, rng = 0, output = 'csr')
+
+    def time_network_mc(self, num_people, mean_degree):
+        self.run()
+
+    def peakmem_network_mc(self, num_people, mean_degree):
+        self.run()
+
+    def track_steps_per_second(self, num_people, mean_degree):
+        return throughput(self.run, self.num_its_network_mc)
+    track_steps_per_second.unit = 'steps/s'
@@ -0,0 +1,49 @@
+'''Benchmarks of graph construction and of the degree-preserving edge swaps of the Metropolis-Hastings chain.'''
+
+import numpy as np
+import epidemic_network_modelling.epidemic_network_modelling as em
+from .common import SIZES, MEAN_DEGREES, degree_sequence, contact_graph, throughput
+
+
+class InitialGraphGenerator(object):
+    params = (SIZES, MEAN_DEGREES, ['csr', 'edges'])
+    param_names = ['num_people', 'mean_degree', 'output']
+
+    def setup(self, num_people, mean_degree, output):
+        self.degrees = degree_sequence(num_people, mean_degree)
+
+    def time_initial_graph_generator(self, num_people, mean_degree, output):
+        em.initial_graph_generator(self.degrees, output = output, rng = 0)
+
+    def peakmem_initial_graph_generator(self, num_people, mean_degree, output):
+        em.initial_graph_generator(self.degrees, output = output, rng = 0)
+
+
+class SwapFunction(object):
+    params = (SIZES, MEAN_DEGREES)
+    param_names = ['num_people', 'mean_degree']
+    num_swaps = 1000
+
+    def setup(self, num_people, mean_degree):
+        self.graph = contact_graph(num_people, mean_degree)
+        self.swap_graph = em.EdgeSwapGraph.from_adjacency(self.graph)
+
+    def time_swap_function(self, num_people, mean_degree):
+        #one swap on a CSR graph, including the conversions in and out of the swap engine
+        em.swap_function(self.graph, rng = 0)
+
+    def peakmem_swap_function(self, num_people, mean_degree):
+        em.swap_function(self.graph, rng = 0)
+
+    def time_edge_swaps(self, num_people, mean_degree):
+        rng = np.random.default_rng(0)
+        for i in range(self.num_swaps):
+            self.swap_graph.swap(rng)
+
+    def track_swaps_per_second(self, num_people, mean_degree):
+        rng = np.random.default_rng(0)
+        def run():
+            for i in range(self.num_swaps):
+                self.swap_graph.swap(rng)
+        return throughput(run, self.num_swaps)
+    track_swaps_per_second.unit = 'swaps/s'
@@ -0,0 +1,77 @@
+'''Benchmarks of the epidemic simulations. Throughput is reported in node-days per second (people times simulated days).'''
+
+import numpy as np
+import epidemic_network_modelling.epidemic_network_modelling as em
+from .common import SIZES, MEAN_DEGREES, contact_graph, throughput
+
+
+class SriMc(object):
+    params = (SIZES, MEAN_DEGREES, ['numpy', 'cython'])
+    param_names = ['num_people', 'mean_degree', 'backend']
+    timeout = 300
+    num_its = 100
+
+    def setup(self, num_people, mean_degree, backend):
+        if backend == 'cython' and em.enm_cython is None:
+            raise NotImplementedError('enm_cython extension not built')
+        self.graph = contact_graph(num_people, mean_degree)
+        self.ages = np.full(num_people, 30)
+
+    def run(self, num_people, mean_degree, backend):
+        em.sri_mc(self.graph, self.ages, .3, .2, .8, num_its = self.num_its, rng = 0, backend = backend)
+
+    def time_sri_mc(self, num_people, mean_degree, backend):
+        self.run(num_people, mean_degree, backend)
+
+    def peakmem_sri_mc(self, num_people, mean_degree, backend):
+        self.run(num_people, mean_degree, backend)
+
+    def track_node_days_per_second(self, num_people, mean_degree, backend):
+        return throughput(lambda: self.run(num_people, mean_degree, backend), num_people * self.num_its)
+    track_node_days_per_second.unit = 'node-days/s'
+
+
+class SriMcEnsemble(object):
+    params = (SIZES[:3], MEAN_DEGREES)
+    param_names = ['num_people', 'mean_degree']
+    timeout = 300
+    num_its = 100
+    n_replicates = 20
+
+    def setup(self, num_people, mean_degree):
+        self.graph = contact_graph(num_people, mean_degree)
+        self.ages = np.full(num_people, 30)
+
+    def run(self):
+        em.sri_mc_ensemble(self.graph, self.ages, .3, .2, .8, num_its = self.num_its, n_replicates = self.n_replicates, rng = 0)
+
+    def time_sri_mc_ensemble(self, num_people, mean_degree):
+        self.run()
+
+    def peakmem_sri_mc_ensemble(self, num_people, mean_degree):
+        self.run()
+
+    def track_node_days_per_second(self, num_people, mean_degree):
+        return throughput(self.run, num_people * self.num_its * self.n_replicates)
+    track_node_days_per_second.unit = 'node-days/s'
+
+
+class SriMcContinuous(object):
+    params = (SIZES[:3], MEAN_DEGREES, ['next_reaction', 'tau_leap'])
+    param_names = ['num_people', 'mean_degree', 'method']
+    timeout = 300
+    num_its = 100
+
+    def setup(self, num_people, mean_degree, method):
+        self.graph = contact_graph(num_people, mean_degree)
+        self.ages = np.full(num_people, 30)
+
+    def run(self, method):
+        em.sri_mc_continuous(self.graph, self.ages, .3, .2, .8, num_its = self.num_its, rng = 0, method = method)
+
+    def time_sri_mc_continuous(self, num_people, mean_degree, method):
+        self.run(method)
+
+    def track_node_days_per_second(self, num_people, mean_degree, method):
+        return throughput(lambda: self.run(method), num_people * self.num_its)
+    track_node_days_per_second.unit = 'node-days/s'
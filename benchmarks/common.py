@@ -0,0 +1,29 @@
+'''Shared helpers for the asv benchmarks: graphs are built once per parameter combination and reused by every benchmark
+method of a class.'''
+
+import time
+import numpy as np
+import epidemic_network_modelling.epidemic_network_modelling as em
+
+#network sizes and mean degrees the benchmarks are parameterized over
+SIZES = [100, 1000, 10000, 100000]
+MEAN_DEGREES = [4, 16]
+
+def degree_sequence(num_people, mean_degree, seed = 0):
+    '''Poisson degree sequence with the given mean, with the last degree bumped if needed to make the sum even.'''
+
+    degrees = np.random.default_rng(seed).poisson(mean_degree, size=num_people)
+    degrees[-1] += degrees.sum() % 2
+    return degrees
+
+def contact_graph(num_people, mean_degree, seed = 0):
+    '''Configuration-model CSR graph with a Poisson degree sequence.'''
+
+    return em.initial_graph_generator(degree_sequence(num_people, mean_degree, seed), output = 'csr', rng = seed)
+
+def throughput(function, work):
+    '''Runs function once and returns work units per second of wall time.'''
+
+    start = time.perf_counter()
+    function()
+    return work / (time.perf_counter() - start)
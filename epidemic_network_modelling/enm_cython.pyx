@@ -1,9 +1,18 @@
+# cython: language_level=3
+cimport cython
 from cython.parallel import prange
 from math import exp 
 # from libc.math cimport exp as c_exp
+from libc.math cimport pow as c_pow
 import numpy as np
 cimport openmp 
 
+#compartment codes, same as in epidemic_network_modelling
+cdef enum:
+    SUSCEPTIBLE = 0
+    INFECTED = 1
+    RECOVERED = 2
+
 
 cdef double cfib(int n):
     cdef int i
@@ -65,83 +74,95 @@ def array_f_multi_wrapper(Y):
 
     return c_array_f_multi(X)
 
-def cython_wrapper_sri_mc(adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability,init_distrib = 0, num_its = 0):
-    if init_distrib == 0:
-        num_people = len(adjacency_matrix)
-        graph_attributes = np.transpose(np.vstack((np.vstack((np.ones(num_people),np.zeros(num_people))), np.zeros(num_people)))) 
-    
-        #first column is susceptible, second infected, third resistant. Each row is a person
-        num_susceptible = [0 for i in range(num_its+1)] #creating our return array. First value in array is the initial distribution
-        num_infected = [0 for i in range(num_its+1)]
-        num_recovered = [0 for i in range(num_its+1)]
-        graph_attributes[0,0] = 0
-        graph_attributes[0,1] = 1 
-        num_susceptible[0] = num_people - 1
-        num_infected[0] = 1
-
-    else:
-        raise ValueError('This option not implemented yet sorry!') #first column is susceptible, second infected, third resistant
-
-    graph_attributes = np.array(graph_attributes,order='C')
-    return c_sri_mc(adjacency_matrix, graph_attributes,age,transmission_probability,recovery_probability,occupation_probability,num_its)
-    # return susceptible, infected, recovered
-
-cdef int c_sri_mc(double[:, ::1] adj_mat, double[:,::1] graph_attributes, long[:, ::1] age, double transmission_probability, double recovery_probability, double occupation_probability, int num_its):
-    
-
-    cdef double[:,::1] num_susceptible = np.zeros((num_its+1,1))
-    cdef double[:,::1] num_infected = np.zeros((num_its + 1,1))
-    cdef double[:,::1] num_recovered = np.zeros((num_its+1,1))
-    cdef int n, i, j
-    cdef long num_possible_infections
-    cdef long[:,::1] infections = np.zeros((len(adj_mat),1),dtype=np.int_)
-    cdef double infection_probability, recovery_threshold, random_event
-
-    for n in range(num_its):
-        infections = np.zeros((len(adj_mat),1)) #number of infection events each person experiences
-        for i in range(len(graph_attributes)):
-            for j in range(len(graph_attributes)): #iterating over every edge in graph
-
-                if i > j: #only counting the lower triangle of the symmetric matrix
-
-                    if adj_mat[i,j] != 0: #only connected people
-
-                        if graph_attributes[i,0] == 1 and graph_attributes[j,1] == 1: 
-                            infections[i,0] += 1
-                            #only counting events b/w an infected and susceptible person
-                        elif graph_attributes[i,1] == 1 and graph_attributes[j,0] == 1:
-                            infections[j,0] += 1
-
-        susceptible = graph_attributes[:,0].nonzero()[0]    
-
-        infected = graph_attributes[:,1].nonzero()[0]
-        for person in susceptible: #for every susceptible person 
-            num_possible_infections = infections[person,0]
-            if num_possible_infections > 0: #if they had at least one opportunity to be infected
-                infection_probability = transmission_probability * occupation_probability #their overall infection probability
-                for i in range(num_possible_infections): 
-                    random_event = np.random.random_sample() 
-                    if infection_probability > random_event: #anything below infection probability considered an infection 
-                        graph_attributes[person,0] = 0 
-                        graph_attributes[person,1] = 1
-                        break 
-
-
-        for person in infected: #for every infected person
-            recovery_threshold = np.random.random_sample()
-            if recovery_probability > recovery_threshold: #anything below recovery probability considered a recovery 
-                graph_attributes[person,1] = 0
-                graph_attributes[person,2] = 1
-
-        num_susceptible[n+1,0], num_infected[n+1,0], num_recovered[n+1,0] = np.sum(graph_attributes,axis=0)
-
-
-    return num_susceptible[:,0], num_infected[:,0], num_recovered[:,0]
-    
-
-
-
-
-
-
-
+def cython_wrapper_sri_mc(adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability,init_distrib = 0, num_its = 0, seed = 0):
+    '''Same inputs and outputs as sri_mc, evolved with the compiled kernel (see csr_sri_mc). The network may be a dense
+    matrix, a scipy.sparse matrix or an edge list.'''
+
+    from epidemic_network_modelling.epidemic_network_modelling import _contact_pattern, _initial_infected #imported here to avoid a cycle
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    state = np.zeros(num_people, dtype=np.int8)
+    state[_initial_infected(init_distrib, num_people)] = INFECTED
+
+    counts = csr_sri_mc(contact_pattern.indptr, contact_pattern.indices, state, transmission_probability * occupation_probability, recovery_probability, num_its, seed)
+    num_susceptible, num_infected, num_recovered = counts.T.tolist()
+    return num_susceptible, num_infected, num_recovered
+
+cdef inline unsigned long long splitmix64(unsigned long long x) noexcept nogil:
+    x = x + 0x9E3779B97F4A7C15ULL
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9ULL
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EBULL
+    return x ^ (x >> 31)
+
+cdef inline double uniform(unsigned long long seed, unsigned long long stream, unsigned long long person) noexcept nogil:
+    #counter-based generator: every (seed, stream, person) triple has its own independent number, so the result does not
+    #depend on how people are split between threads
+    return (splitmix64(seed ^ splitmix64(stream ^ splitmix64(person))) >> 11) * (1.0 / 9007199254740992.0)
+
+@cython.boundscheck(False) #the lengths are checked once below; all indices are non-negative
+@cython.wraparound(False)
+def csr_sri_mc(const int[::1] indptr, const int[::1] indices, signed char[::1] state, double infection_probability, double recovery_probability, int num_its, unsigned long long seed, const double[::1] susceptibility = None):
+    '''Evolves the per-person state array (0 susceptible, 1 infected, 2 recovered) over num_its days on the CSR contact
+    pattern (indptr, indices) with the same daily rule as sri_mc, using OpenMP threads and no GIL. Every day each person
+    is updated in parallel from the previous day's states; random numbers come from a counter-based generator keyed on
+    (seed, day, person), so results are reproducible for a seed whatever the number of threads. An optional per-person
+    susceptibility vector multiplies each person's infection probability (capped at 1). Returns the (num_its + 1, 3)
+    array of susceptible, infected and recovered counts. state is updated in place.'''
+
+    cdef Py_ssize_t num_people = state.shape[0]
+    if indptr.shape[0] != num_people + 1 or (susceptibility is not None and susceptibility.shape[0] != num_people):
+        raise ValueError('indptr and susceptibility must match the number of people')
+    cdef signed char[::1] current = state
+    cdef signed char[::1] following = np.empty(num_people, dtype=np.int8)
+    cdef signed char[::1] swap
+    cdef long long[:, ::1] counts = np.zeros((num_its + 1, 3), dtype=np.int64)
+    cdef double escape_probability = 1 - infection_probability
+    cdef double person_escape_probability
+    cdef bint heterogeneous = susceptibility is not None
+    cdef Py_ssize_t i
+    cdef int day, edge, exposures
+    cdef signed char person_state
+    cdef long long num_susceptible, num_infected, num_recovered
+
+    for i in range(num_people):
+        counts[0, current[i]] += 1
+
+    for day in range(num_its):
+        num_susceptible = 0
+        num_infected = 0
+        num_recovered = 0
+        for i in prange(num_people, nogil=True, schedule='static'):
+            person_state = current[i]
+            if person_state == SUSCEPTIBLE:
+                exposures = 0
+                for edge in range(indptr[i], indptr[i + 1]):
+                    if current[indices[edge]] == INFECTED:
+                        exposures = exposures + 1
+                if exposures > 0:
+                    person_escape_probability = escape_probability
+                    if heterogeneous:
+                        person_escape_probability = 1 - min(infection_probability * susceptibility[i], 1.0)
+                    if uniform(seed, 2 * day, i) >= c_pow(person_escape_probability, exposures):
+                        person_state = INFECTED
+            elif person_state == INFECTED:
+                if uniform(seed, 2 * day + 1, i) < recovery_probability:
+                    person_state = RECOVERED
+            following[i] = person_state
+
+            if person_state == SUSCEPTIBLE:
+                num_susceptible += 1
+            elif person_state == INFECTED:
+                num_infected += 1
+            else:
+                num_recovered += 1
+
+        counts[day + 1, 0] = num_susceptible
+        counts[day + 1, 1] = num_infected
+        counts[day + 1, 2] = num_recovered
+        swap = current
+        current = following
+        following = swap
+
+    if num_people > 0 and &current[0] != &state[0]: #odd number of days, latest states are in the scratch buffer
+        state[:] = current
+    return np.asarray(counts)
@@ -1,15 +1,633 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import tempfile
+import time
+from multiprocessing import shared_memory
 import numpy as np
 import scipy.stats as ss 
-import networkx as nx
+import scipy.sparse as sp
 
-def initial_graph_generator(degree_sequence):
-    '''This function uses networkx's implemented random graph generator to generate a pseudograph 
-    from the given degree distribution. Pseudograph may contain self-edges and loops. As n gets large these can be ignored.
+try:
+    import enm_cython #compiled OpenMP kernel, built by setup.py
+except ImportError: #fall back to the numpy implementation
+    enm_cython = None
 
-    Input: degree_sequency (list of integers).'''
-    return nx.to_numpy_matrix(nx.configuration_model(degree_sequence))
+def initial_graph_generator(degree_sequence, output = 'dense', remove_self_loops = False, remove_multi_edges = False, rng = None):
+    '''This function generates a random pseudograph from the given degree distribution with the configuration model: every
+    person gets as many edge stubs as their degree and the stubs are paired uniformly at random. Pseudograph may contain
+    self-edges and loops. As n gets large these can be ignored, or they can be dropped with remove_self_loops and
+    remove_multi_edges (which lowers the degrees of the people involved). Memory and time scale with the number of edges.
 
-def sri_mc (adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability, init_distrib = 0,num_its = 100):
+    Input: degree_sequency (list of integers).
+    output : [optional] 'dense' (numpy array adjacency matrix), 'csr' (scipy.sparse CSR adjacency matrix), 'compact'
+        (CompactGraph) or 'edges' ((m, 2) edge array). In the adjacency matrices entries count repeated edges and the
+        diagonal counts self-edges once each
+    rng : [optional] numpy.random.Generator or integer seed'''
+
+    rng = np.random.default_rng(rng)
+    degrees = np.asarray(degree_sequence, dtype=np.int64)
+    if degrees.sum() % 2 != 0:
+        raise ValueError('Invalid degree sequence: sum of degrees must be even')
+    num_people = len(degrees)
+
+    stubs = np.repeat(np.arange(num_people, dtype=np.int64), degrees)
+    rng.shuffle(stubs)
+    edges = stubs.reshape(-1, 2)
+    if remove_self_loops:
+        edges = edges[edges[:,0] != edges[:,1]]
+    if remove_multi_edges:
+        keys = np.unique(np.minimum(edges[:,0], edges[:,1]) * num_people + np.maximum(edges[:,0], edges[:,1]))
+        edges = np.column_stack(np.divmod(keys, num_people))
+    return _graph_output(edges, num_people, output)
+
+def edge_list_to_csr(edge_list, num_people = None):
+    '''This function converts an undirected edge list into a symmetric scipy.sparse CSR adjacency matrix. Repeated edges
+    are summed into multiplicities and self-edges are stored once on the diagonal, matching the dense matrices returned by
+    initial_graph_generator.
+
+    Inputs
+    ------
+
+    edge_list : array of integers of shape (m, 2) (each row is a pair of connected people)
+    num_people : [optional] integer (number of people in the network). Defaults to the largest label plus one.'''
+
+    edges = np.asarray(edge_list, dtype=np.int64).reshape(-1, 2)
+    if num_people is None:
+        num_people = int(edges.max()) + 1 if len(edges) else 0
+    off_diagonal = edges[:,0] != edges[:,1] #self-edges are only stored once
+    rows = np.concatenate((edges[:,0], edges[off_diagonal,1]))
+    cols = np.concatenate((edges[:,1], edges[off_diagonal,0]))
+    data = np.ones(len(rows), dtype=np.int32)
+    return sp.csr_matrix((data, (rows, cols)), shape=(num_people, num_people))
+
+class CompactGraph(object):
+    '''Memory-light container of an undirected (multi)graph: every connected pair of people is stored once, as an upper
+    triangle entry (row <= col, self-edges on the diagonal) with its multiplicity, sorted by row and column. The people are
+    stored in the smallest unsigned integer type that holds their labels and the multiplicities in the smallest one that
+    holds the largest, so a graph takes a few bytes per edge instead of the 8 n^2 bytes of a dense float matrix.
+    sri_mc and the other simulations, swap_function, graph_fingerprint and EdgeSwapGraph accept it anywhere an adjacency
+    matrix is accepted, and initial_graph_generator and network_mc can return it (output='compact').
+
+    Inputs
+    ------
+
+    edges : array of integers of shape (m, 2) (each row is a pair of connected people; self-edges and repeats allowed)
+    num_people : integer (number of people in the network)'''
+
+    __slots__ = ('num_people', 'rows', 'cols', 'counts')
+
+    def __init__(self, edges, num_people):
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.num_people = int(num_people)
+        keys, counts = np.unique(np.minimum(edges[:,0], edges[:,1]) * self.num_people + np.maximum(edges[:,0], edges[:,1]), return_counts=True)
+        rows, cols = np.divmod(keys, max(self.num_people, 1))
+        index_dtype = np.min_scalar_type(max(self.num_people - 1, 0))
+        self.rows = rows.astype(index_dtype)
+        self.cols = cols.astype(index_dtype)
+        self.counts = counts.astype(np.min_scalar_type(counts.max() if len(counts) else 1))
+
+    @classmethod
+    def from_adjacency(cls, graph):
+        '''Builds the compact form of any graph accepted by EdgeSwapGraph.from_adjacency.'''
+
+        if isinstance(graph, cls):
+            return graph
+        edges, num_people = _edge_array(graph)
+        return cls(edges, num_people)
+
+    @property
+    def shape(self):
+        return (self.num_people, self.num_people)
+
+    @property
+    def num_edges(self):
+        return int(self.counts.sum(dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.cols.nbytes + self.counts.nbytes
+
+    @property
+    def edges(self):
+        '''(m, 2) int64 edge array, with repeated edges repeated.'''
+
+        pairs = np.column_stack((self.rows, self.cols)).astype(np.int64)
+        return np.repeat(pairs, self.counts, axis=0) if len(pairs) and self.counts.max() > 1 else pairs
+
+    def degrees(self):
+        '''Degree of every person, self-edges counting twice as in the degree sequence of initial_graph_generator.'''
+
+        return (np.bincount(self.rows, weights=self.counts, minlength=self.num_people) +
+            np.bincount(self.cols, weights=self.counts, minlength=self.num_people)).astype(np.int64)
+
+    def contact_pattern(self):
+        '''The binary contact pattern of the graph (see _contact_pattern), built without a dense or triangular copy.'''
+
+        off_diagonal = self.rows != self.cols
+        upper = sp.csr_matrix((np.ones(off_diagonal.sum(), dtype=np.int32), (self.rows[off_diagonal].astype(np.int64), self.cols[off_diagonal].astype(np.int64))), shape=self.shape)
+        return (upper + upper.T).tocsr()
+
+    def to_csr(self):
+        '''Symmetric CSR adjacency matrix with the multiplicities, as returned by edge_list_to_csr.'''
+
+        off_diagonal = self.rows != self.cols
+        rows = np.concatenate((self.rows, self.cols[off_diagonal])).astype(np.int64)
+        cols = np.concatenate((self.cols, self.rows[off_diagonal])).astype(np.int64)
+        data = np.concatenate((self.counts, self.counts[off_diagonal])).astype(np.int32)
+        return sp.csr_matrix((data, (rows, cols)), shape=self.shape)
+
+    def to_dense(self):
+        return self.to_csr().toarray()
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactGraph) and self.num_people == other.num_people and np.array_equal(self.rows, other.rows)
+            and np.array_equal(self.cols, other.cols) and np.array_equal(self.counts, other.counts))
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return 'CompactGraph({} people, {} edges, {} bytes)'.format(self.num_people, self.num_edges, self.nbytes)
+
+def _graph_output(edges, num_people, output):
+    '''Converts an edge array to the graph form named by output: 'dense', 'csr', 'compact' or 'edges'.'''
+
+    if output == 'edges':
+        return edges
+    elif output == 'compact':
+        return CompactGraph(edges, num_people)
+    elif output == 'csr':
+        return edge_list_to_csr(edges, num_people)
+    elif output == 'dense':
+        return edge_list_to_csr(edges, num_people).toarray()
+    raise ValueError("output must be 'dense', 'csr', 'compact' or 'edges'")
+
+def _contact_pattern(adjacency_matrix):
+    '''Returns the contact structure of a graph as a binary, symmetric CSR matrix with an empty diagonal. Accepts a dense
+    matrix, a scipy.sparse matrix or an (m, 2) edge list. As in the original dense loop, only the lower triangle of the
+    adjacency matrix is read and edge multiplicities are ignored (two people are either in contact or not).'''
+
+    if _is_contact_pattern(adjacency_matrix):
+        return adjacency_matrix #already prepared, e.g. by load_csr_graph; used without a copy
+    if isinstance(adjacency_matrix, CompactGraph):
+        return adjacency_matrix.contact_pattern()
+    if sp.issparse(adjacency_matrix):
+        adjacency = sp.csr_matrix(adjacency_matrix)
+    elif _is_edge_list(adjacency_matrix):
+        adjacency = edge_list_to_csr(adjacency_matrix)
+    else:
+        adjacency = sp.csr_matrix(np.asarray(adjacency_matrix))
+
+    lower = sp.tril(adjacency != 0, k=-1).astype(np.int32)
+    return (lower + lower.T).tocsr()
+
+def _is_contact_pattern(matrix):
+    '''True for a CSR matrix that already is a contact pattern: int32 ones in canonical format with an empty diagonal.
+    Such matrices (as written by save_csr_graph) are trusted to be symmetric. The checks scan the arrays once and do not
+    copy them.'''
+
+    if not sp.issparse(matrix) or matrix.format != 'csr' or matrix.dtype != np.int32 or matrix.shape[0] != matrix.shape[1]:
+        return False
+    if matrix.nnz and (matrix.data.min() != 1 or matrix.data.max() != 1):
+        return False
+    return bool(matrix.has_canonical_format) and not matrix.diagonal().any()
+
+_CSR_FILES = ('indptr', 'indices', 'data')
+
+def save_csr_graph(graph, path):
+    '''This function stores the contact pattern of a graph as .npy files in the directory path (created if needed), so
+    that load_csr_graph can later memory-map it instead of rebuilding it. indptr.npy and indices.npy hold the CSR structure
+    and data.npy its int32 ones. If the off-diagonal adjacency entries are not all 1 (e.g. repeated edges), they are
+    kept in weights.npy, aligned with indices.npy.
+
+    Inputs
+    ------
+
+    graph : adjacency matrix (dense or scipy.sparse) or (m, 2) edge list
+    path : string (directory to write the files to)'''
+
+    if _is_edge_list(graph):
+        graph = edge_list_to_csr(graph)
+    adjacency = sp.csr_matrix(graph)
+    lower = sp.tril(adjacency, k=-1)
+    lower.eliminate_zeros()
+    weights = (lower + lower.T).tocsr()
+    weights.sort_indices()
+    contact_pattern = _contact_pattern(adjacency)
+
+    os.makedirs(path, exist_ok=True)
+    for name in _CSR_FILES:
+        np.save(os.path.join(path, name + '.npy'), getattr(contact_pattern, name))
+    weights_file = os.path.join(path, 'weights.npy')
+    if weights.nnz and (weights.data != 1).any():
+        np.save(weights_file, weights.data)
+    elif os.path.exists(weights_file):
+        os.remove(weights_file)
+
+def load_csr_graph(path, mmap_mode = 'r', return_weights = False):
+    '''This function opens a contact pattern written by save_csr_graph or edge_file_to_csr_graph. With the default
+    mmap_mode the arrays are memory-mapped rather than read: the graph may be larger than RAM, loading is immediate, and
+    all processes that load the same files share one copy in the page cache. The returned matrix is passed to sri_mc,
+    sri_mc_ensemble, sri_mc_frontier and the choice functions without being copied.
+
+    Inputs
+    ------
+
+    path : string (directory holding the .npy files)
+    mmap_mode : [optional] mmap_mode of numpy.load ('r' by default; None reads the arrays into memory)
+    return_weights : [optional] boolean (also return the edge weights, or None if the graph has none)
+
+    Outputs
+    -------
+    contact_pattern : scipy.sparse CSR matrix backed by the files
+    weights : [only if return_weights] array aligned with contact_pattern.indices, or None'''
+
+    indptr, indices, data = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in _CSR_FILES]
+    num_people = len(indptr) - 1
+    contact_pattern = sp.csr_matrix((data, indices, indptr), shape=(num_people, num_people), copy=False)
+    if not return_weights:
+        return contact_pattern
+    weights_file = os.path.join(path, 'weights.npy')
+    weights = np.load(weights_file, mmap_mode=mmap_mode) if os.path.exists(weights_file) else None
+    return contact_pattern, weights
+
+def _edge_chunks(edge_file, chunk_size):
+    '''Yields an edge file as (k, 2) int64 arrays of at most chunk_size edges. .npy files are memory-mapped; any other file
+    is read as text with one whitespace separated pair of people per line (lines starting with # are skipped).'''
+
+    if str(edge_file).endswith('.npy'):
+        edges = np.load(edge_file, mmap_mode='r')
+        for start in range(0, len(edges), chunk_size):
+            yield np.asarray(edges[start:start + chunk_size], dtype=np.int64).reshape(-1, 2)
+        return
+    with open(edge_file) as lines:
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield np.loadtxt(chunk, dtype=np.int64, ndmin=2).reshape(-1, 2)
+
+def edge_file_to_csr_graph(edge_file, path, num_people = None, chunk_size = 2**20):
+    '''This function converts an on-disk edge list into the memory-mapped files of save_csr_graph without ever holding the
+    edges in memory: only arrays with one entry per person and chunks of chunk_size edges are kept in RAM. The edge file
+    is read twice (to count the contacts of every person, then to place them) and the contact lists are then sorted and
+    de-duplicated in place. Self-edges and repeated edges are dropped, as in _contact_pattern.
+
+    Inputs
+    ------
+
+    edge_file : string (a .npy file holding an (m, 2) integer array, or a text file with one "person person" pair per line)
+    path : string (directory to write the files to)
+    num_people : [optional] integer (number of people in the network). Defaults to the largest label plus one.
+    chunk_size : [optional] integer (number of edges processed at a time)'''
+
+    degrees = np.zeros(num_people or 0, dtype=np.int64)
+    for edges in _edge_chunks(edge_file, chunk_size):
+        edges = edges[edges[:,0] != edges[:,1]]
+        counts = np.bincount(edges.ravel(), minlength=len(degrees))
+        if len(counts) > len(degrees):
+            degrees = np.concatenate((degrees, np.zeros(len(counts) - len(degrees), dtype=np.int64)))
+        degrees += counts
+    num_people = len(degrees)
+    indptr = np.concatenate(([0], np.cumsum(degrees)))
+    index_dtype = np.int32 if max(indptr[-1], num_people) < 2**31 else np.int64
+
+    os.makedirs(path, exist_ok=True)
+    unsorted_file = os.path.join(path, 'indices.unsorted.npy')
+    unsorted = np.lib.format.open_memmap(unsorted_file, mode='w+', dtype=index_dtype, shape=(int(indptr[-1]),))
+    position = indptr[:-1].copy() #next free slot in every person's contact list
+    for edges in _edge_chunks(edge_file, chunk_size):
+        edges = edges[edges[:,0] != edges[:,1]]
+        rows = np.concatenate((edges[:,0], edges[:,1]))
+        cols = np.concatenate((edges[:,1], edges[:,0]))
+        order = np.argsort(rows, kind='stable')
+        rows, cols = rows[order], cols[order]
+        first = np.searchsorted(rows, rows) #rank of each contact among the chunk's contacts of the same person
+        unsorted[position[rows] + np.arange(len(rows)) - first] = cols
+        position += np.bincount(rows, minlength=num_people)
+
+    #sort and de-duplicate blocks of whole rows, compacting the contact lists towards the front of the file
+    new_indptr = np.zeros(num_people + 1, dtype=index_dtype)
+    written = 0
+    start = 0
+    while start < num_people:
+        stop = max(int(np.searchsorted(indptr, indptr[start] + chunk_size, side='right')) - 1, start + 1)
+        rows = np.repeat(np.arange(start, stop, dtype=np.int64), degrees[start:stop])
+        keys = np.unique(rows * num_people + unsorted[indptr[start]:indptr[stop]])
+        new_indptr[start+1:stop+1] = written + np.cumsum(np.bincount(keys // num_people - start, minlength=stop - start))
+        unsorted[written:written + len(keys)] = keys % num_people
+        written += len(keys)
+        start = stop
+
+    indices = np.lib.format.open_memmap(os.path.join(path, 'indices.npy'), mode='w+', dtype=index_dtype, shape=(written,))
+    data = np.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+', dtype=np.int32, shape=(written,))
+    for start in range(0, written, chunk_size):
+        stop = min(start + chunk_size, written)
+        indices[start:stop] = unsorted[start:stop]
+        data[start:stop] = 1
+    indices.flush()
+    data.flush()
+    np.save(os.path.join(path, 'indptr.npy'), new_indptr)
+    del unsorted, indices, data
+    os.remove(unsorted_file)
+    weights_file = os.path.join(path, 'weights.npy')
+    if os.path.exists(weights_file):
+        os.remove(weights_file)
+
+#compartment codes used in the per-person state arrays
+SUSCEPTIBLE, INFECTED, RECOVERED = 0, 1, 2
+
+def _susceptibility_vector(susceptibility, num_people):
+    '''Checks and converts an optional per-person susceptibility vector.'''
+
+    if susceptibility is None:
+        return None
+    susceptibility = np.ascontiguousarray(susceptibility, dtype=np.float64)
+    if susceptibility.shape != (num_people,):
+        raise ValueError('susceptibility must have one value per person')
+    return susceptibility
+
+def _escape_probability(infection_probability, susceptibility, people, exposures):
+    '''Probability that each of the given people, with the given numbers of infected contacts, escapes infection today. A
+    person's per-contact infection probability is infection_probability times their susceptibility (capped at 1).'''
+
+    if susceptibility is None:
+        return (1 - infection_probability) ** exposures
+    return (1 - np.minimum(infection_probability * susceptibility[people], 1)) ** exposures
+
+class CompartmentModel(object):
+    '''Description of a discrete-time compartment model on a contact network, run by model_mc and model_mc_ensemble and
+    accepted by min_epidemic_choice_fx and network_mc as model=.
+
+    Every day each person may move out of their state along one of its transitions, decided by the states at the start
+    of the day. A transition (source, target, probability) happens with the given daily probability. A transition
+    (source, target, probability, driver) is caused by contacts in state driver: a person with k such contacts escapes
+    each independently, so it happens with probability 1 - (1 - probability * susceptibility)^k. The probabilities out of
+    one state should add up to at most 1. Each person draws one random number per day, and only if they are in a state
+    with a daily transition or have a contact that can drive one. Draws are made state by state, in the order in which
+    the states first appear as sources, and within a state in increasing order of the person's index.
+
+    Inputs
+    ------
+
+    states : list of strings (names of the compartments. The first one is everybody's initial state and the one counted
+        by the choice functions)
+    transitions : list of (source, target, probability) or (source, target, probability, driver) tuples of state names
+    seed_state : [optional] string (state of the initially infected people. Defaults to the first driver state)'''
+
+    def __init__(self, states, transitions, seed_state = None):
+        self.states = tuple(states)
+        if len(set(self.states)) != len(self.states) or not 0 < len(self.states) < 128:
+            raise ValueError('states must be between 1 and 127 distinct names')
+        self.transitions = tuple(tuple(transition) for transition in transitions)
+        compiled = []
+        for transition in self.transitions:
+            if len(transition) not in (3, 4):
+                raise ValueError('transitions must be (source, target, probability) or (source, target, probability, driver)')
+            source, target, probability = self.index(transition[0]), self.index(transition[1]), float(transition[2])
+            driver = self.index(transition[3]) if len(transition) == 4 and transition[3] is not None else None
+            compiled.append((source, target, probability, driver))
+        if seed_state is None:
+            drivers = [driver for _, _, _, driver in compiled if driver is not None]
+            seed_state = self.states[drivers[0]] if drivers else self.states[0]
+        self.seed_state = seed_state
+        self._seed = self.index(seed_state)
+
+        #per source state, in order of first appearance: daily transitions (target, probability) and contact transitions
+        #(target, probability, driver)
+        self._sources = []
+        for source in dict.fromkeys(source for source, _, _, _ in compiled):
+            daily = [(target, probability) for s, target, probability, driver in compiled if s == source and driver is None]
+            contact = [(target, probability, driver) for s, target, probability, driver in compiled if s == source and driver is not None]
+            self._sources.append((source, daily, contact))
+        self._drivers = sorted(set(driver for _, _, _, driver in compiled if driver is not None))
+
+    def index(self, state):
+        '''Code of the named state in the per-person state arrays.'''
+
+        if state not in self.states:
+            raise ValueError('Unknown state {!r}'.format(state))
+        return self.states.index(state)
+
+    def description(self):
+        '''JSON-serializable description, the inverse of CompartmentModel(**description).'''
+
+        transitions = [list(transition[:2]) + [float(transition[2])] + list(transition[3:]) for transition in self.transitions]
+        return dict(states=list(self.states), transitions=transitions, seed_state=self.seed_state)
+
+    def __repr__(self):
+        return 'CompartmentModel({!r}, {!r}, seed_state={!r})'.format(list(self.states), list(self.transitions), self.seed_state)
+
+def sir_model(transmission_probability, recovery_probability, occupation_probability):
+    '''The model of sri_mc: susceptible people are infected by infected contacts, who recover (or die) for good.'''
+
+    return CompartmentModel(('S', 'I', 'R'), [('S', 'I', transmission_probability * occupation_probability, 'I'), ('I', 'R', recovery_probability)])
+
+def sis_model(transmission_probability, recovery_probability, occupation_probability):
+    '''Recovered people are immediately susceptible again.'''
+
+    return CompartmentModel(('S', 'I'), [('S', 'I', transmission_probability * occupation_probability, 'I'), ('I', 'S', recovery_probability)])
+
+def seir_model(transmission_probability, progression_probability, recovery_probability, occupation_probability):
+    '''Infected people are first exposed (E, not yet infectious) and become infectious with daily probability
+    progression_probability. The index case starts out infectious.'''
+
+    return CompartmentModel(('S', 'E', 'I', 'R'), [('S', 'E', transmission_probability * occupation_probability, 'I'), ('E', 'I', progression_probability), ('I', 'R', recovery_probability)])
+
+def sirs_model(transmission_probability, recovery_probability, waning_probability, occupation_probability):
+    '''Recovered people lose their immunity with daily probability waning_probability.'''
+
+    return CompartmentModel(('S', 'I', 'R'), [('S', 'I', transmission_probability * occupation_probability, 'I'), ('I', 'R', recovery_probability), ('R', 'S', waning_probability)])
+
+def _model_day(contact_pattern, state, model, rng, susceptibility = None):
+    '''Advances an (n_replicates, number of people) state array by one day of the compartment model in place, with one
+    sparse matrix product per driver state counting the driving contacts of every person in every replicate. Returns, for
+    every source state of the model, the flat indices (replicate * number of people + person) of the people that left it
+    together with the state they moved to.'''
+
+    num_people = state.shape[1]
+    exposures = {}
+    for driver in model._drivers:
+        exposures[driver] = contact_pattern.dot((state == driver).T.view(np.int8).astype(np.int32)).T.ravel()
+
+    moves = []
+    flat = state.ravel()
+    for source, daily, contact in model._sources:
+        in_source = flat == source
+        if not daily: #only people with a driving contact can move
+            in_source &= np.logical_or.reduce([exposures[driver] > 0 for _, _, driver in contact])
+        people = np.flatnonzero(in_source)
+        u = rng.random(len(people))
+        target = np.full(len(people), source, dtype=state.dtype)
+
+        lower = np.zeros(len(people)) #daily transitions take [0, p_1), [p_1, p_1 + p_2), ...
+        for daily_target, probability in daily:
+            upper = lower + probability
+            target[(u >= lower) & (u < upper)] = daily_target
+            lower = upper
+        upper = None #contact transitions take [1 - P_1, 1), [1 - P_1 - P_2, 1 - P_1), ...
+        for contact_target, probability, driver in contact:
+            escape_probability = _escape_probability(probability, susceptibility, people % num_people, exposures[driver][people])
+            if upper is None:
+                lower = escape_probability
+                target[u >= lower] = contact_target
+            else:
+                lower = upper - (1 - escape_probability)
+                target[(u >= lower) & (u < upper)] = contact_target
+            upper = lower
+
+        moved = target != source
+        moves.append((people[moved], target[moved]))
+    for people, target in moves:
+        flat[people] = target
+    return moves
+
+def _model_ensemble(contact_pattern, state, model, num_its, rng, susceptibility = None):
+    '''Advances an (n_replicates, number of people) state array num_its days in place and returns the (number of states,
+    n_replicates, num_its + 1) array of the counts of every state.'''
+
+    num_states = len(model.states)
+    counts = np.zeros((num_states, state.shape[0], num_its+1), dtype=np.int64)
+    for compartment in range(num_states):
+        counts[compartment,:,0] = np.count_nonzero(state == compartment, axis=1)
+
+    for n in range(num_its):
+        _model_day(contact_pattern, state, model, rng, susceptibility)
+        for compartment in range(num_states):
+            counts[compartment,:,n+1] = np.count_nonzero(state == compartment, axis=1)
+
+    return counts
+
+def _initial_infected(init_distrib, num_people):
+    '''Sorted indices of the initially infected people described by init_distrib, which may be 0 (the first person, the
+    default), a boolean mask, an array of 0s and 1s with one entry per person, or an array of indices. An integer array of
+    length num_people holding only 0s and 1s is always read as the 0/1 indicator.'''
+
+    if np.ndim(init_distrib) == 0:
+        people = np.array([0 if init_distrib is None else init_distrib], dtype=np.int64)
+    else:
+        distrib = np.asarray(init_distrib)
+        if distrib.dtype == bool:
+            if distrib.shape != (num_people,):
+                raise ValueError('A boolean init_distrib must have one entry per person')
+            people = np.flatnonzero(distrib)
+        elif distrib.shape == (num_people,) and np.all((distrib == 0) | (distrib == 1)):
+            people = np.flatnonzero(distrib)
+        else:
+            people = np.unique(distrib.astype(np.int64).ravel())
+    if len(people) and (people.min() < 0 or people.max() >= num_people):
+        raise ValueError('init_distrib refers to people outside the network')
+    return people
+
+def _initial_model_state(model, n_replicates, num_people, init_distrib = 0):
+    state = np.zeros((n_replicates, num_people), dtype=np.int8) #everybody in the first state
+    state[:,_initial_infected(init_distrib, num_people)] = model._seed
+    return state
+
+def model_mc(adjacency_matrix, model, init_distrib = 0, num_its = 100, rng = None, susceptibility = None):
+    '''This function runs a compartment model (see CompartmentModel, e.g. seir_model(...)) on the given network, with the
+    same vectorized kernel as sri_mc's numpy backend. The initially infected people (init_distrib, as in sri_mc) start in
+    the model's seed_state; everybody else starts in the first state.
+
+    Inputs
+    ------
+
+    adjacency_matrix : adjacency matrix (dense or scipy.sparse) or (m, 2) edge list, as in sri_mc
+    model : CompartmentModel
+    init_distrib, num_its, rng, susceptibility : [optional] as in sri_mc
+
+    Outputs
+    -------
+    One list of integers per state of model.states (the number of people in that state at each time step, starting
+    with the initial distribution)'''
+
+    counts = model_mc_ensemble(adjacency_matrix, model, init_distrib, num_its, 1, rng, susceptibility)
+    return tuple(count[0].tolist() for count in counts)
+
+def model_mc_ensemble(adjacency_matrix, model, init_distrib = 0, num_its = 100, n_replicates = 100, rng = None, susceptibility = None):
+    '''Runs n_replicates independent copies of model_mc on the same network at once, like sri_mc_ensemble. Returns one
+    array of integers of shape (n_replicates, num_its + 1) per state of model.states. With a single replicate the counts
+    are the same as model_mc's for the same rng.'''
+
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    state = _initial_model_state(model, n_replicates, contact_pattern.shape[0], init_distrib)
+    susceptibility = _susceptibility_vector(susceptibility, contact_pattern.shape[0])
+    return tuple(_model_ensemble(contact_pattern, state, model, num_its, rng, susceptibility))
+
+def _sri_day(contact_pattern, state, infection_probability, recovery_probability, rng, susceptibility = None):
+    '''Advances the per-person state array by one day of sir_model in place and returns the people newly infected and
+    newly recovered. A susceptible person with k infected contacts escapes each of them independently, so they are
+    infected with probability 1 - (1 - infection_probability)^k. People infected at the start of the day recover with
+    probability recovery_probability; people infected today cannot also recover today. Only susceptible people with at
+    least one infected contact draw a random number, in increasing order of their index, followed by one draw per
+    infected person.'''
+
+    model = sir_model(infection_probability, recovery_probability, 1)
+    (newly_infected, _), (newly_recovered, _) = _model_day(contact_pattern, state.reshape(1, -1), model, rng, susceptibility)
+    return newly_infected, newly_recovered
+
+def prepare_graph(adjacency_matrix):
+    '''Returns the contact pattern of a graph (a binary, symmetric CSR matrix with an empty diagonal). Passing it instead of
+    the graph to sri_mc, the ensembles or seeding_ensemble skips the conversion, so many runs on one network only build
+    the sparse structure once.'''
+
+    return _contact_pattern(adjacency_matrix)
+
+def seeding_ensemble(adjacency_matrix, seed_sets, transmission_probability, recovery_probability, occupation_probability, num_its = 100, n_replicates = 1, rng = None, susceptibility = None, model = None, max_rows = None):
+    '''This function runs the epidemic from many different initial infection distributions on one network. The contact
+    pattern is built once and every seed set (n_replicates times) becomes one row of a single ensemble, so each day costs
+    one sparse matrix product for all of them together. With max_rows the rows are run in batches of at most that many,
+    which bounds the memory to about 6 * max_rows bytes per person.
+
+    Inputs
+    ------
+
+    adjacency_matrix : adjacency matrix, edge list or prepare_graph output
+    seed_sets : list of initial infection distributions in any form accepted as init_distrib by sri_mc (or a 2-D boolean
+        array with one mask per row)
+    transmission_probability, recovery_probability, occupation_probability : as in sri_mc
+    num_its, rng, susceptibility : [optional] as in sri_mc
+    n_replicates : [optional] integer > 0 (number of simulations of every seed set)
+    model : [optional] CompartmentModel to run instead of the SIR model given by the three probabilities
+    max_rows : [optional] integer (largest number of simulations advanced together)
+
+    Outputs
+    -------
+    One array of integers of shape (len(seed_sets), n_replicates, num_its + 1) per state (susceptible, infected and
+    recovered for the SIR model, model.states otherwise)'''
+
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    if model is None:
+        model = sir_model(transmission_probability, recovery_probability, occupation_probability)
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    seeds = [_initial_infected(seed_set, num_people) for seed_set in seed_sets]
+
+    rows = len(seeds) * n_replicates
+    max_rows = rows if max_rows is None else max_rows
+    counts = np.zeros((len(model.states), rows, num_its+1), dtype=np.int64)
+    for start in range(0, rows, max(max_rows, 1)):
+        stop = min(start + max_rows, rows)
+        state = np.zeros((stop - start, num_people), dtype=np.int8)
+        for row in range(start, stop):
+            state[row - start, seeds[row // n_replicates]] = model._seed
+        counts[:, start:stop] = _model_ensemble(contact_pattern, state, model, num_its, rng, susceptibility)
+    return tuple(counts.reshape(len(model.states), len(seeds), n_replicates, num_its+1))
+
+def sri_mc (adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability, init_distrib = 0,num_its = 100, rng = None, backend = 'auto', susceptibility = None):
     '''This function evolves the given network (represented by its adjacency matrix) over time. At each time step a
     certain subsection of the infected population randomly recovers/dies and a certain subsection of the susceptible 
     population is infected. 
@@ -30,7 +648,10 @@ def sri_mc (adjacency_matrix, age,transmission_probability,recovery_probability,
     Inputs
     ------
 
-    adjacency_matrix : symmetric numpy array of integers (the adjacency matrix for the network) 
+    adjacency_matrix : symmetric numpy array of integers (the adjacency matrix for the network). May also be a scipy.sparse
+        matrix or an (m, 2) edge list; all three give the same trajectories for the same random seed. A 2 x 2 array
+        is read as an adjacency matrix if it is symmetric and as a list of two edges otherwise. Graphs larger than RAM
+        can be memory-mapped with load_csr_graph
     ages : array of integers of same length as adjacency matrix (the ages of each person)
     transmission_probability : float from 0 to 1 (probability an infected person connected to a susceptible person infects her)
     recovery_probability : float from 0 to 1 (probability an infected person recovers/dies)
@@ -39,7 +660,16 @@ def sri_mc (adjacency_matrix, age,transmission_probability,recovery_probability,
         --- Each array address corresponds to the same person as the ages value and the adjacency_matrix row of same address
         --- Each array value should be a 0 if the person is not infected and a 1 if the person is infected
         --- If no initial distribution is passed in, the first person is assumed to be patient 0 and the analysis procedes
+        --- May also be a boolean mask or an array of the indices of the infected people (see seeding_ensemble to run
+            many initial distributions at once)
     num_its : [optional] integer > 0 (number of iterations to evolve the model over. Each iteration can be considered a day) 
+    rng : [optional] numpy.random.Generator or integer seed (source of randomness; pass one for reproducible runs)
+    backend : [optional] 'auto', 'cython' or 'numpy'. 'cython' runs the days in the compiled OpenMP kernel of enm_cython
+        (its own random number generator is seeded from rng, so its trajectories differ from the numpy ones for the same
+        rng); 'auto' uses it whenever the extension has been built and the contact pattern has int32 indices (graphs
+        with more than 2^31 contacts, e.g. from edge_file_to_csr_graph, use int64 indices and run with numpy)
+    susceptibility : [optional] array of floats of same length as adjacency matrix (per-person multiplier of the infection
+        probability of every contact, e.g. age_susceptibility(ages)). Defaults to 1 for everyone
 
     Outputs
     -------
@@ -49,70 +679,666 @@ def sri_mc (adjacency_matrix, age,transmission_probability,recovery_probability,
     num_infected : array of integers (the number of remaining infected people at each time step)
     num_recovered : array of integers (the number of recovered/dead people at each time step)'''
 
-    if init_distrib == 0:
-        num_people = len(adjacency_matrix)
-        graph_attributes = np.transpose(np.vstack((np.vstack((np.ones(num_people),np.zeros(num_people))), np.zeros(num_people)))) 
-    
-        #first column is susceptible, second infected, third resistant. Each row is a person
-        num_susceptible = [0 for i in range(num_its+1)] #first value in array is the initial distribution
-        num_infected = [0 for i in range(num_its+1)]
-        num_recovered = [0 for i in range(num_its+1)]
-        graph_attributes[0,0] = 0
-        graph_attributes[0,1] = 1 
-        num_susceptible[0] = num_people - 1
-        num_infected[0] = 1
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    state = np.full(num_people, SUSCEPTIBLE, dtype=np.int8) #one entry per person
+    state[_initial_infected(init_distrib, num_people)] = INFECTED
 
+    infection_probability = transmission_probability * occupation_probability #probability a single contact infects
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    int32_indices = contact_pattern.indptr.dtype == np.int32 and contact_pattern.indices.dtype == np.int32 #all the kernel takes
+    if backend == 'cython' or (backend == 'auto' and enm_cython is not None and int32_indices):
+        if enm_cython is None:
+            raise ImportError('The enm_cython extension is not built (run python setup.py build_ext --inplace)')
+        if not int32_indices:
+            raise ValueError("The cython backend needs int32 indices, use backend='numpy' for this graph")
+        counts = enm_cython.csr_sri_mc(contact_pattern.indptr, contact_pattern.indices, state, infection_probability, recovery_probability, num_its, rng.integers(2**63), susceptibility)
     else:
-        return ValueError('This option not implemented yet. Sorry!') #first column is susceptible, second infected, third resistant
+        counts = np.zeros((num_its+1, 3), dtype=np.int64) #first row is the initial distribution
+        counts[0] = np.bincount(state, minlength=3)
+        for n in range(num_its):
+            _sri_day(contact_pattern, state, infection_probability, recovery_probability, rng, susceptibility)
+            counts[n+1] = np.bincount(state, minlength=3)
+
+    num_susceptible, num_infected, num_recovered = counts.T.tolist()
+    return num_susceptible, num_infected, num_recovered
+
 
+def sri_mc_iter(adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability, init_distrib = 0,num_its = 100, rng = None, susceptibility = None, sink = None, replicate = 0):
+    '''Generator version of sri_mc (numpy backend): yields the (num_susceptible, num_infected, num_recovered) counts of the
+    initial distribution and then of each day as it is computed, so nothing but the current state is kept in memory. For the
+    same rng the counts are the same as sri_mc(..., backend='numpy').
 
+    If a sink (e.g. a TrajectorySink) is given, every change of state is also passed to sink.write(day, people, event,
+    replicate), with event INFECTED or RECOVERED; the initially infected people are written as infections on day 0.
+    Inputs are otherwise the same as sri_mc.'''
+
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    state = np.full(num_people, SUSCEPTIBLE, dtype=np.int8)
+    state[_initial_infected(init_distrib, num_people)] = INFECTED
+
+    infection_probability = transmission_probability * occupation_probability
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    counts = np.bincount(state, minlength=3)
+    if sink is not None:
+        sink.write(0, np.flatnonzero(state == INFECTED), INFECTED, replicate)
+    yield tuple(counts.tolist())
 
     for n in range(num_its):
-        infections = np.zeros((len(adjacency_matrix),1)) #number of infection events each person experiences
+        newly_infected, newly_recovered = _sri_day(contact_pattern, state, infection_probability, recovery_probability, rng, susceptibility)
+        counts += (-len(newly_infected), len(newly_infected) - len(newly_recovered), len(newly_recovered))
+        if sink is not None:
+            sink.write(n+1, newly_infected, INFECTED, replicate)
+            sink.write(n+1, newly_recovered, RECOVERED, replicate)
+        yield tuple(counts.tolist())
+
+class TrajectorySink(object):
+    '''Append-only store of per-person state changes, written as numbered .npy chunks in a directory. Records are buffered
+    in memory and flushed to a new chunk file every chunk_size records (and on close), so memory use stays flat however
+    many days or replicates are written. Each record holds the replicate, the day, the person and the event (INFECTED or
+    RECOVERED). Opening an existing directory appends new chunks after the ones already there. Use read_trajectory to get
+    per-person infection and recovery times back.
+
+    Inputs
+    ------
 
-        for i in range(len(graph_attributes)):
-            for j in range(len(graph_attributes)): #iterating over every edge in graph
+    path : string (directory for the chunk files, created if needed)
+    chunk_size : [optional] integer > 0 (number of records per chunk file)'''
 
-                if i > j: #only counting the lower triangle of the symmetric matrix
+    record_dtype = np.dtype([('replicate', np.int32), ('day', np.int32), ('person', np.int64), ('event', np.int8)])
 
-                    if adjacency_matrix[i,j] != 0: #only connected people
+    def __init__(self, path, chunk_size = 2**20):
+        self.path = path
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+        self._num_chunks = len(_chunk_files(path))
+        self._buffer = np.empty(chunk_size, dtype=self.record_dtype)
+        self._size = 0
 
-                        if graph_attributes[i,0] == 1 and graph_attributes[j,1] == 1: 
-                            infections[i] += 1
-                            pass
-                            #only counting events b/w an infected and susceptible person
-                        elif graph_attributes[i,1] == 1 and graph_attributes[j,0] == 1:
-                            infections[j] += 1
-                            pass
+    def write(self, day, people, event, replicate = 0):
+        people = np.asarray(people)
+        start = 0
+        while start < len(people): #fill the buffer, flushing whenever it is full
+            stop = start + min(len(people) - start, self.chunk_size - self._size)
+            records = self._buffer[self._size:self._size + stop - start]
+            records['replicate'] = replicate
+            records['day'] = day
+            records['person'] = people[start:stop]
+            records['event'] = event
+            self._size += stop - start
+            start = stop
+            if self._size == self.chunk_size:
+                self.flush()
 
-        susceptible = graph_attributes[:,0].nonzero()[0]    
+    def flush(self):
+        if self._size == 0:
+            return
+        file_name = os.path.join(self.path, 'chunk_{:06d}.npy'.format(self._num_chunks))
+        with open(file_name + '.tmp', 'wb') as chunk_file: #complete chunks only ever appear under their final name
+            np.save(chunk_file, self._buffer[:self._size])
+        os.replace(file_name + '.tmp', file_name)
+        self._num_chunks += 1
+        self._size = 0
 
-        infected = graph_attributes[:,1].nonzero()[0]
-        for person in susceptible: #for every susceptible person
-            num_possible_infections = int(infections[person])
-            if num_possible_infections > 0: #if they had at least one opportunity to be infected
-                infection_probability = transmission_probability * occupation_probability #their overall infection probability
-                for i in range(num_possible_infections): 
-                    random_event = np.random.random_sample() 
-                    if infection_probability > random_event: #anything below infection probability considered an infection 
-                        graph_attributes[person,0] = 0 
-                        graph_attributes[person,1] = 1
-                        break 
+    def close(self):
+        self.flush()
 
+    def __enter__(self):
+        return self
 
-        for person in infected: #for every infected person
-            recovery_threshold = np.random.random_sample()
-            if recovery_probability > recovery_threshold: #anything below recovery probability considered a recovery 
-                graph_attributes[person,1] = 0
-                graph_attributes[person,2] = 1
+    def __exit__(self, *exc_info):
+        self.close()
 
-        num_susceptible[n+1], num_infected[n+1], num_recovered[n+1] = np.sum(graph_attributes,axis=0)
+def _chunk_files(path):
+    return sorted(name for name in os.listdir(path) if name.startswith('chunk_') and name.endswith('.npy'))
 
+def read_trajectory(path, num_people, replicate = 0):
+    '''Reads the records of one replicate from a TrajectorySink directory, one chunk at a time, and returns two arrays of
+    length num_people with the day each person was infected and the day they recovered (-1 if it never happened).'''
 
+    infection_time = np.full(num_people, -1, dtype=np.int64)
+    recovery_time = np.full(num_people, -1, dtype=np.int64)
+    for name in _chunk_files(path):
+        records = np.load(os.path.join(path, name), mmap_mode='r')
+        records = records[records['replicate'] == replicate]
+        for event, times in ((INFECTED, infection_time), (RECOVERED, recovery_time)):
+            selected = records[records['event'] == event]
+            times[selected['person']] = selected['day']
+    return infection_time, recovery_time
+
+def sri_mc_ensemble(adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability, init_distrib = 0,num_its = 100, n_replicates = 100, rng = None, susceptibility = None):
+    '''Runs n_replicates independent copies of sri_mc on the same network at once. The states of all replicates are held in
+    one (n_replicates, number of people) array and advanced together, with a single sparse matrix product per day counting
+    the infected contacts of every person in every replicate. The graph is converted to its contact pattern only once.
+
+    Inputs are the same as sri_mc, plus
+
+    n_replicates : [optional] integer > 0 (number of independent simulations to run)
+
+    Outputs
+    -------
+    num_susceptible, num_infected, num_recovered : arrays of integers of shape (n_replicates, num_its + 1) (the counts at
+        each time step, one row per replicate)'''
+
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    state = np.full((n_replicates, num_people), SUSCEPTIBLE, dtype=np.int8) #one row per replicate
+    state[:,_initial_infected(init_distrib, num_people)] = INFECTED
+
+    infection_probability = transmission_probability * occupation_probability
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    num_susceptible, num_infected, num_recovered = _sri_ensemble(contact_pattern, state, infection_probability, recovery_probability, num_its, rng, susceptibility)
     return num_susceptible, num_infected, num_recovered
 
+def _sri_ensemble(contact_pattern, state, infection_probability, recovery_probability, num_its, rng, susceptibility = None):
+    '''Advances an (n_replicates, number of people) state array num_its days of sir_model in place and returns the (3,
+    n_replicates, num_its + 1) array of susceptible, infected and recovered counts.'''
+
+    return _model_ensemble(contact_pattern, state, sir_model(infection_probability, recovery_probability, 1), num_its, rng, susceptibility)
+
+class _SharedCSR(object):
+    '''Copies the arrays of a CSR matrix into shared memory blocks once, so that worker processes can attach to them by
+    name instead of receiving a pickled copy of the graph with every task. Only the small description returned by
+    describe() needs to be sent to the workers. Call close() when the workers are done to free the blocks.'''
+
+    def __init__(self, matrix):
+        self._blocks = []
+        self._arrays = []
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+            self._blocks.append(block)
+            self._arrays.append((block.name, array.dtype.str, len(array)))
+        self._shape = matrix.shape
+
+    def describe(self):
+        return self._shape, tuple(self._arrays)
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+def _attach_csr(description):
+    '''Worker-side counterpart of _SharedCSR: returns the CSR matrix backed directly by the shared memory blocks (no copy)
+    together with the blocks, which must be closed once the matrix is no longer used.'''
+
+    shape, arrays = description
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in arrays]
+    data, indices, indptr = [np.ndarray((length,), dtype=np.dtype(dtype), buffer=block.buf) for block, (_, dtype, length) in zip(blocks, arrays)]
+    return sp.csr_matrix((data, indices, indptr), shape=shape, copy=False), blocks
+
+def _shared_final_susceptible(description, init_distrib, infection_probability, recovery_probability, num_its, n_replicates, seed_sequence, susceptibility = None, model = None):
+    '''Process pool task: simulates n_replicates epidemics on a contact pattern held in shared memory and returns the
+    final number of susceptible people (of people in the model's first state) of each replicate.'''
+
+    if model is None:
+        model = sir_model(infection_probability, recovery_probability, 1)
+    contact_pattern, blocks = _attach_csr(description)
+    try:
+        state = _initial_model_state(model, n_replicates, contact_pattern.shape[0], init_distrib)
+        counts = _model_ensemble(contact_pattern, state, model, num_its, np.random.default_rng(seed_sequence), susceptibility)
+        return counts[0,:,num_its].copy()
+    finally:
+        del contact_pattern
+        for block in blocks:
+            block.close()
+
+def _parallel_final_susceptible(graphs, init_distrib, transmission_probability, recovery_probability, occupation_probability, num_its, n_replicates, executor, n_workers, rng, susceptibility = None, model = None):
+    '''Summed final numbers of susceptible people of each graph, see _parallel_final_susceptible_draws.'''
+
+    return [int(draws.sum()) for draws in _parallel_final_susceptible_draws(graphs, init_distrib, transmission_probability, recovery_probability, occupation_probability, num_its, n_replicates, executor, n_workers, rng, susceptibility, model)]
+
+def _parallel_final_susceptible_draws(graphs, init_distrib, transmission_probability, recovery_probability, occupation_probability, num_its, n_replicates, executor, n_workers, rng, susceptibility = None, model = None):
+    '''Spreads n_replicates simulations of each of the given graphs over the executor's worker processes and returns the
+    final numbers of susceptible people of every replicate, one array per graph. Each graph is placed in shared memory once per call, and
+    every task gets its own child stream of a numpy.random.SeedSequence drawn from rng, so results are reproducible for a
+    given rng and n_workers.'''
+
+    infection_probability = transmission_probability * occupation_probability
+    chunks = [len(chunk) for chunk in np.array_split(np.arange(n_replicates), n_workers) if len(chunk) > 0]
+    seed_sequence = np.random.SeedSequence(rng.integers(2**63, size=2))
+
+    shared_graphs = []
+    try:
+        futures = []
+        for graph in graphs:
+            contact_pattern = _contact_pattern(graph)
+            graph_susceptibility = _susceptibility_vector(susceptibility, contact_pattern.shape[0]) #checked here, not in the workers
+            shared_graphs.append(_SharedCSR(contact_pattern))
+            for chunk, child in zip(chunks, seed_sequence.spawn(len(chunks))):
+                futures.append(executor.submit(_shared_final_susceptible, shared_graphs[-1].describe(), init_distrib,
+                    infection_probability, recovery_probability, num_its, chunk, child, graph_susceptibility, model))
+        results = [future.result() for future in futures]
+    finally:
+        for shared_graph in shared_graphs:
+            shared_graph.close()
+    return [np.concatenate(results[k*len(chunks):(k+1)*len(chunks)]) for k in range(len(graphs))]
+
+def sweep_dtype(num_its):
+    '''Record type of parameter_sweep results: the parameters of the grid point, its index, the replicate and the counts of
+    every day.'''
+
+    return np.dtype([('transmission_probability', np.float64), ('recovery_probability', np.float64), ('occupation_probability', np.float64),
+        ('point', np.int64), ('replicate', np.int32), ('num_susceptible', np.int32, (num_its+1,)), ('num_infected', np.int32, (num_its+1,)),
+        ('num_recovered', np.int32, (num_its+1,))])
+
+def _sweep_points(contact_pattern, points, first_point, seed_sequences, num_its, n_replicates, init_distrib, susceptibility):
+    '''Simulates n_replicates epidemics at each of the given (transmission, recovery, occupation) grid points, point k with
+    its own seed sequence, and returns the sweep_dtype records (grid points numbered from first_point).'''
+
+    records = np.zeros(len(points) * n_replicates, dtype=sweep_dtype(num_its))
+    for k, ((transmission_probability, recovery_probability, occupation_probability), seed_sequence) in enumerate(zip(points, seed_sequences)):
+        state = np.full((n_replicates, contact_pattern.shape[0]), SUSCEPTIBLE, dtype=np.int8)
+        state[:,_initial_infected(init_distrib, contact_pattern.shape[0])] = INFECTED
+        counts = _sri_ensemble(contact_pattern, state, transmission_probability * occupation_probability, recovery_probability, num_its, np.random.default_rng(seed_sequence), susceptibility)
+        point_records = records[k*n_replicates:(k+1)*n_replicates]
+        point_records['transmission_probability'] = transmission_probability
+        point_records['recovery_probability'] = recovery_probability
+        point_records['occupation_probability'] = occupation_probability
+        point_records['point'] = first_point + k
+        point_records['replicate'] = np.arange(n_replicates)
+        for compartment, name in enumerate(('num_susceptible', 'num_infected', 'num_recovered')):
+            point_records[name] = counts[compartment]
+    return records
+
+def _shared_sweep_points(description, points, first_point, seed_sequences, num_its, n_replicates, init_distrib, susceptibility):
+    '''Process pool task of parameter_sweep: _sweep_points on a contact pattern held in shared memory.'''
+
+    contact_pattern, blocks = _attach_csr(description)
+    try:
+        return _sweep_points(contact_pattern, points, first_point, seed_sequences, num_its, n_replicates, init_distrib, susceptibility)
+    finally:
+        del contact_pattern
+        for block in blocks:
+            block.close()
+
+def parameter_sweep(adjacency_matrix, transmission_probabilities, recovery_probabilities, occupation_probabilities, num_its = 100, n_replicates = 10, n_workers = 1, rng = None, path = None, chunk_size = 16, init_distrib = 0, susceptibility = None):
+    '''This function runs sri_mc_ensemble at every point of the grid of all combinations of the given transmission,
+    recovery and occupation probabilities on one network. The graph is converted to its contact pattern once and, with
+    n_workers > 1, placed in shared memory once for all worker processes, which each simulate chunks of chunk_size grid
+    points. Every grid point gets its own child stream of one numpy.random.SeedSequence, so the results do not depend on
+    n_workers, chunk_size or on interruptions.
+
+    If path is given, every chunk of results is saved there as soon as it is done (as points_<first point>.npy, written
+    atomically) together with sweep.json describing the sweep. Calling parameter_sweep again with the same path and
+    arguments skips the chunks already saved, so an interrupted sweep continues where it stopped; with rng=None the
+    seed of the interrupted sweep is reused. A ValueError is raised if the saved sweep was made with other arguments,
+    including another network, init_distrib or susceptibility. read_sweep(path) loads the results.
+
+    Inputs
+    ------
+
+    adjacency_matrix : adjacency matrix, edge list or prepare_graph output
+    transmission_probabilities, recovery_probabilities, occupation_probabilities : lists of floats (values of the grid)
+    num_its, init_distrib, susceptibility : [optional] as in sri_mc
+    n_replicates : [optional] integer > 0 (number of simulations per grid point)
+    n_workers : [optional] integer > 0 (number of worker processes)
+    rng : [optional] integer seed or numpy.random.Generator
+    path : [optional] string (directory for resumable output)
+    chunk_size : [optional] integer > 0 (number of grid points per task and output file)
+
+    Outputs
+    -------
+    structured array of sweep_dtype(num_its) records, one per grid point and replicate, in grid order (transmission
+    probability varying slowest)'''
+
+    points = [tuple(point) for point in itertools.product(np.asarray(transmission_probabilities, dtype=np.float64).tolist(),
+        np.asarray(recovery_probabilities, dtype=np.float64).tolist(), np.asarray(occupation_probabilities, dtype=np.float64).tolist())]
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    #the network, seeding and susceptibilities are identified by hashes, so a resume on different ones is refused
+    settings = dict(points=points, num_its=int(num_its), n_replicates=int(n_replicates), chunk_size=int(chunk_size), num_people=int(num_people),
+        graph=_digest(contact_pattern.indptr.astype(np.int64)) + _digest(contact_pattern.indices.astype(np.int64)),
+        infected=_digest(_initial_infected(init_distrib, num_people)), susceptibility=_digest(susceptibility) if susceptibility is not None else None)
+    saved = None
+    settings_file_name = os.path.join(path, 'sweep.json') if path is not None else None
+    if settings_file_name is not None and os.path.exists(settings_file_name):
+        with open(settings_file_name) as settings_file:
+            saved = json.load(settings_file)
+        saved['points'] = [tuple(point) for point in saved['points']]
+        if rng is None: #continue with the seed of the interrupted sweep
+            rng = saved['entropy']
+    if isinstance(rng, np.random.Generator):
+        rng = rng.integers(2**63, size=2).tolist()
+    entropy = settings['entropy'] = np.random.SeedSequence(rng).entropy
+    if saved is not None and saved != settings:
+        raise ValueError('{} holds a different sweep'.format(path))
+    if settings_file_name is not None and saved is None:
+        os.makedirs(path, exist_ok=True)
+        with open(settings_file_name + '.tmp', 'w') as settings_file:
+            json.dump(settings, settings_file)
+        os.replace(settings_file_name + '.tmp', settings_file_name)
+
+    seed_sequences = np.random.SeedSequence(entropy).spawn(len(points))
+    chunks = {}
+    starts = []
+    for start in range(0, len(points), chunk_size):
+        file_name = os.path.join(path, 'points_{:09d}.npy'.format(start)) if path is not None else None
+        if file_name is not None and os.path.exists(file_name):
+            chunks[start] = np.load(file_name)
+        else:
+            starts.append(start)
+
+    def save(start, records):
+        chunks[start] = records
+        if path is not None:
+            file_name = os.path.join(path, 'points_{:09d}.npy'.format(start))
+            with open(file_name + '.tmp', 'wb') as chunk_file:
+                np.save(chunk_file, records)
+            os.replace(file_name + '.tmp', file_name)
+
+    arguments = [(points[start:start + chunk_size], start, seed_sequences[start:start + chunk_size], num_its, n_replicates, init_distrib, susceptibility) for start in starts]
+    if n_workers > 1 and len(starts) > 0:
+        shared_graph = _SharedCSR(contact_pattern)
+        try:
+            with ProcessPoolExecutor(n_workers) as executor:
+                futures = dict((executor.submit(_shared_sweep_points, shared_graph.describe(), *argument), argument[1]) for argument in arguments)
+                for future in as_completed(futures):
+                    save(futures[future], future.result())
+        finally:
+            shared_graph.close()
+    else:
+        for argument in arguments:
+            save(argument[1], _sweep_points(contact_pattern, *argument))
+
+    return np.concatenate([chunks[start] for start in sorted(chunks)]) if chunks else np.zeros(0, dtype=sweep_dtype(num_its))
+
+def read_sweep(path):
+    '''Loads the results saved so far by parameter_sweep(..., path=path), in grid order.'''
+
+    names = sorted(name for name in os.listdir(path) if name.startswith('points_') and name.endswith('.npy'))
+    return np.concatenate([np.load(os.path.join(path, name)) for name in names]) if names else None
+
+def _neighbours(contact_pattern, people):
+    '''Returns the concatenated contact lists of the given people (with repeats) from a CSR contact pattern, touching only
+    their own rows.'''
+
+    starts = contact_pattern.indptr[people]
+    lengths = contact_pattern.indptr[people + 1] - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return contact_pattern.indices[np.repeat(starts, lengths) + offsets]
+
+def _frontier_step(contact_pattern, state, infected, frontier, exposures, escape_probability, recovery_probability, rng):
+    '''One step of sri_mc_frontier and of the tau_leap method of sri_mc_continuous: each person of the frontier is
+    infected unless they escape with the given probability, then each infected person recovers with recovery_probability
+    (one draw per person, in increasing order of their index). state and exposures are updated in place. Returns the new
+    infected and frontier arrays and the people newly infected and newly recovered.'''
+
+    newly_infected = frontier[rng.random(len(frontier)) >= escape_probability]
+    recovering = rng.random(len(infected)) < recovery_probability
+    newly_recovered = infected[recovering]
+    state[newly_infected] = INFECTED
+    state[newly_recovered] = RECOVERED
+
+    #only the contacts of people who changed state see a different number of infected contacts
+    newly_exposed = _neighbours(contact_pattern, newly_infected)
+    np.add.at(exposures, newly_exposed, 1)
+    np.subtract.at(exposures, _neighbours(contact_pattern, newly_recovered), 1)
+
+    infected = np.union1d(infected[~recovering], newly_infected)
+    frontier = np.union1d(frontier, newly_exposed)
+    frontier = frontier[(state[frontier] == SUSCEPTIBLE) & (exposures[frontier] > 0)]
+    return infected, frontier, newly_infected, newly_recovered
+
+def sri_mc_frontier(adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability, init_distrib = 0,num_its = 100, rng = None, susceptibility = None):
+    '''Event-driven version of sri_mc. Instead of rescanning every person and contact each day, this keeps the sorted set of
+    infected people, the number of infected contacts of every person, and the frontier of susceptible people with at least
+    one infected contact. Each day only the frontier and infected people draw random numbers, and only the contacts of people
+    who changed state are updated, so the cost of a day scales with the size of the frontier rather than with the network.
+    Once nobody is infected the remaining days are filled in with the final counts.
+
+    The random numbers are drawn in the same order as sri_mc(..., backend='numpy'), so for the same rng both functions
+    return identical trajectories. Inputs and outputs are the same as sri_mc.'''
+
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    state = np.full(num_people, SUSCEPTIBLE, dtype=np.int8)
+    state[_initial_infected(init_distrib, num_people)] = INFECTED
+
+    infection_probability = transmission_probability * occupation_probability
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    infected = np.flatnonzero(state == INFECTED)
+    exposures = np.zeros(num_people, dtype=np.int32) #number of infected contacts of each person
+    np.add.at(exposures, _neighbours(contact_pattern, infected), 1)
+    frontier = np.flatnonzero((state == SUSCEPTIBLE) & (exposures > 0))
+
+    counts = np.zeros((num_its+1, 3), dtype=np.int64)
+    counts[0] = np.bincount(state, minlength=3)
 
-def network_mc(degree_sequence, ages, choice_function, transmission_probability, recovery_probability,occupation_probability,graph_percent,num_its_network_mc = 10, num_its_sri_mc = 100):
+    for n in range(num_its):
+        if len(infected) == 0: #epidemic is over, nothing can change any more
+            counts[n+1:] = counts[n]
+            break
+
+        escape_probability = _escape_probability(infection_probability, susceptibility, frontier, exposures[frontier])
+        infected, frontier, newly_infected, newly_recovered = _frontier_step(contact_pattern, state, infected, frontier, exposures, escape_probability, recovery_probability, rng)
+        counts[n+1] = counts[n] + (-len(newly_infected), len(newly_infected) - len(newly_recovered), len(newly_recovered))
+
+    num_susceptible, num_infected, num_recovered = counts.T.tolist()
+    return num_susceptible, num_infected, num_recovered
+
+class _EventQueue(object):
+    '''Indexed binary min-heap of the time of the next event of every person. Each person has at most one entry, whose
+    time can be changed or removed in O(log n) through the position index; people without an entry have time inf.'''
+
+    def __init__(self, num_people):
+        self.times = [np.inf] * num_people
+        self._heap = [] #people, ordered by time
+        self._position = [-1] * num_people #index of every person in _heap, -1 if absent
+
+    def first(self):
+        '''(time, person) of the earliest event, or (inf, -1) if there is none.'''
+
+        if not self._heap:
+            return np.inf, -1
+        return self.times[self._heap[0]], self._heap[0]
+
+    def update(self, person, time):
+        '''Sets the time of the person's next event, removing it for time inf.'''
+
+        position = self._position[person]
+        if time == np.inf:
+            if position >= 0:
+                self._remove(position)
+            return
+        self.times[person] = time
+        if position < 0:
+            self._heap.append(person)
+            self._position[person] = position = len(self._heap) - 1
+        self._sift_down(self._sift_up(position))
+
+    def _remove(self, position):
+        person, last = self._heap[position], self._heap.pop()
+        self._position[person] = -1
+        self.times[person] = np.inf
+        if position < len(self._heap): #move the last entry into the hole
+            self._heap[position] = last
+            self._position[last] = position
+            self._sift_down(self._sift_up(position))
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._position[heap[i]] = i
+        self._position[heap[j]] = j
+
+    def _sift_up(self, position):
+        times, heap = self.times, self._heap
+        while position > 0:
+            parent = (position - 1) // 2
+            if times[heap[parent]] <= times[heap[position]]:
+                break
+            self._swap(parent, position)
+            position = parent
+        return position
+
+    def _sift_down(self, position):
+        times, heap = self.times, self._heap
+        while True:
+            child = 2 * position + 1
+            if child >= len(heap):
+                return position
+            if child + 1 < len(heap) and times[heap[child + 1]] < times[heap[child]]:
+                child += 1
+            if times[heap[position]] <= times[heap[child]]:
+                return position
+            self._swap(position, child)
+            position = child
+
+#daily probabilities of 1 are turned into this (very fast but finite) rate
+_MAX_DAILY_PROBABILITY = 1 - 1e-12
+
+def _daily_rate(probability):
+    '''Rate of an exponential waiting time (per day) that ends within a day with the given probability.'''
+
+    return -np.log1p(-np.minimum(probability, _MAX_DAILY_PROBABILITY))
+
+def sri_mc_continuous(adjacency_matrix, age,transmission_probability,recovery_probability,occupation_probability, init_distrib = 0,num_its = 100, rng = None, susceptibility = None, method = 'next_reaction', tau = .1):
+    '''Continuous-time version of sri_mc. The daily probabilities are turned into rates so that a single contact, or a
+    single infected person, acts with the same probability within one day as in sri_mc: every infected contact infects a
+    susceptible person at rate -log(1 - transmission_probability * occupation_probability * susceptibility) and infected
+    people recover at rate -log(1 - recovery_probability). Unlike sri_mc, events are not limited to one per person per day
+    (a person can be infected and recover on the same day, and pass the infection on in between). The state at the end of
+    every day is returned, on the same grid as sri_mc.
+
+    With method='next_reaction' the epidemic is simulated exactly with the next-reaction method of Gibson and Bruck: the
+    time of the next event of every person is kept in an indexed priority queue, and an event only reschedules the person
+    and their susceptible contacts (rescaling their remaining waiting times to the new rates). The cost is proportional to
+    the number of events times the number of contacts of the people involved, and does not depend on num_its.
+
+    With method='tau_leap' time advances in fixed steps of tau days (rounded so that a whole number of steps make a day)
+    during which the rates are taken as constant, like the days of sri_mc_frontier. This approximates the continuous-time
+    epidemic with a cost per step proportional to the infected people and their contacts, which is cheaper than tracking
+    single events when many people are infected at once.
+
+    Inputs are the same as sri_mc, plus
+
+    method : [optional] 'next_reaction' or 'tau_leap'
+    tau : [optional] float between 0 and 1 (length of a step of the tau_leap method, in days)
+
+    Outputs are the same as sri_mc.'''
+
+    rng = np.random.default_rng(rng)
+    contact_pattern = _contact_pattern(adjacency_matrix)
+    num_people = contact_pattern.shape[0]
+    state = np.full(num_people, SUSCEPTIBLE, dtype=np.int8)
+    state[_initial_infected(init_distrib, num_people)] = INFECTED
+
+    infection_probability = transmission_probability * occupation_probability
+    susceptibility = _susceptibility_vector(susceptibility, num_people)
+    infection_rate = _daily_rate(infection_probability * (susceptibility if susceptibility is not None else np.ones(num_people))) #per infected contact
+    recovery_rate = float(_daily_rate(recovery_probability))
+
+    if method == 'next_reaction':
+        counts = _next_reaction_sri(contact_pattern, state, infection_rate, recovery_rate, num_its, rng)
+    elif method == 'tau_leap':
+        counts = _tau_leap_sri(contact_pattern, state, infection_rate, recovery_rate, num_its, rng, tau)
+    else:
+        raise ValueError("method must be 'next_reaction' or 'tau_leap'")
+
+    num_susceptible, num_infected, num_recovered = counts.T.tolist()
+    return num_susceptible, num_infected, num_recovered
+
+def _next_reaction_sri(contact_pattern, state, infection_rate, recovery_rate, num_its, rng):
+    '''Simulates the SIR epidemic in continuous time until day num_its (see sri_mc_continuous) and returns the
+    (num_its + 1, 3) counts at the end of every day.'''
+
+    num_people = len(state)
+    indptr, indices = contact_pattern.indptr, contact_pattern.indices
+    infection_rate = infection_rate.tolist()
+    state = state.tolist()
+    exposures = [0] * num_people #number of infected contacts of each person
+    queue = _EventQueue(num_people)
+    infection_times, recovery_times = [], []
+
+    def expose(person, change, now):
+        old = exposures[person]
+        exposures[person] = new = old + change
+        if new == 0 or infection_rate[person] == 0:
+            queue.update(person, np.inf)
+        elif old == 0: #no infection was scheduled
+            queue.update(person, now + rng.standard_exponential() / (infection_rate[person] * new))
+        else: #same remaining exponential clock, run at the new rate
+            queue.update(person, now + (queue.times[person] - now) * old / new)
+
+    def infect(person, now):
+        state[person] = INFECTED
+        if recovery_rate > 0:
+            queue.update(person, now + rng.standard_exponential() / recovery_rate)
+        else:
+            queue.update(person, np.inf)
+        for contact in indices[indptr[person]:indptr[person + 1]].tolist():
+            if state[contact] == SUSCEPTIBLE:
+                expose(contact, 1, now)
+
+    initially_infected = [person for person in range(num_people) if state[person] == INFECTED]
+    for person in initially_infected:
+        infect(person, 0.)
+
+    while True:
+        now, person = queue.first()
+        if now > num_its:
+            break
+        if state[person] == SUSCEPTIBLE:
+            infection_times.append(now)
+            infect(person, now)
+        else:
+            recovery_times.append(now)
+            state[person] = RECOVERED
+            queue.update(person, np.inf)
+            for contact in indices[indptr[person]:indptr[person + 1]].tolist():
+                if state[contact] == SUSCEPTIBLE:
+                    expose(contact, -1, now)
+
+    #the events happen in time order, so the counts at the end of every day follow by binary search
+    days = np.arange(num_its + 1)
+    infections = np.searchsorted(infection_times, days, side='right')
+    recoveries = np.searchsorted(recovery_times, days, side='right')
+    counts = np.empty((num_its+1, 3), dtype=np.int64)
+    counts[:,0] = num_people - len(initially_infected) - infections
+    counts[:,1] = len(initially_infected) + infections - recoveries
+    counts[:,2] = recoveries
+    return counts
+
+def _tau_leap_sri(contact_pattern, state, infection_rate, recovery_rate, num_its, rng, tau):
+    '''Simulates the SIR epidemic in steps of tau days (see sri_mc_continuous) and returns the (num_its + 1, 3) counts at
+    the end of every day. The frontier and infected people are tracked as in sri_mc_frontier.'''
+
+    if not 0 < tau <= 1:
+        raise ValueError('tau must be between 0 and 1')
+    steps_per_day = int(round(1 / tau))
+    tau = 1. / steps_per_day
+    recovery_probability = -np.expm1(-recovery_rate * tau)
+    infected = np.flatnonzero(state == INFECTED)
+    exposures = np.zeros(len(state), dtype=np.int32)
+    np.add.at(exposures, _neighbours(contact_pattern, infected), 1)
+    frontier = np.flatnonzero((state == SUSCEPTIBLE) & (exposures > 0))
+
+    counts = np.zeros((num_its+1, 3), dtype=np.int64)
+    counts[0] = current = np.bincount(state, minlength=3)
+    last_day = 0
+    for n in range(num_its * steps_per_day):
+        if len(infected) == 0: #epidemic is over, nothing can change any more
+            break
+        escape_probability = np.exp(-infection_rate[frontier] * exposures[frontier] * tau)
+        infected, frontier, newly_infected, newly_recovered = _frontier_step(contact_pattern, state, infected, frontier, exposures, escape_probability, recovery_probability, rng)
+        current = current + (-len(newly_infected), len(newly_infected) - len(newly_recovered), len(newly_recovered))
+        if (n + 1) % steps_per_day == 0:
+            last_day = (n + 1) // steps_per_day
+            counts[last_day] = current
+
+    counts[last_day+1:] = current
+    return counts
+
+def network_mc(degree_sequence, ages, choice_function, transmission_probability, recovery_probability,occupation_probability,graph_percent,num_its_network_mc = 10, num_its_sri_mc = 100, n_workers = 1, rng = None, cache_scores = True, common_random_numbers = False, susceptibility = None, stats = False, callback = None, checkpoint = None, checkpoint_every = 100, model = None, result_cache = None, output = 'dense', sequential = False, batch_size = 10, confidence = .95):
     ''' This function iterates randomly over many possible networks in the graph, selecting the top networks using a 
     supplied choice function. Typically the choice function will involve evolving the given network over many different possible
     configurations using a swap function that maintains the input degree sequence. 
@@ -123,7 +1349,8 @@ def network_mc(degree_sequence, ages, choice_function, transmission_probability,
 
     Inputs
     ------
-    degree sequence : array of integers (the degree sequence for every person in the network)
+    degree sequence : array of integers (the degree sequence for every person in the network), or a CompactGraph to start
+        the chain from instead of a random graph with that degree sequence
     ages : array of integers of same length as degree sequence (the ages of each person)
     choice function : function that takes inputs as follows: choice_fx(candidate_state,current_state,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc)
     transmission_probability : float from 0 to 1 (probability an infected person connected to a susceptible person infects her)
@@ -133,35 +1360,570 @@ def network_mc(degree_sequence, ages, choice_function, transmission_probability,
         --- Each array address corresponds to the same person as the ages value and the adjacency_matrix row of same address
         --- Each array value should be a 0 if the person is not infected and a 1 if the person is infected
         --- If no initial distribution is passed in, the first person is assumed to be patient 0 and the analysis procedes
+    n_workers : [optional] integer > 0 (number of worker processes used to evaluate the choice function). With more than one
+        worker a single process pool is created for the whole run and passed to the choice function as executor=pool,
+        n_workers=n_workers
+    rng : [optional] numpy.random.Generator or integer seed (used for the swaps and passed to the choice function as rng=rng)
+    cache_scores : [optional] boolean (keep the current state's score between steps and pass it to the choice function as
+        score_cache, so only the candidate is simulated)
+    common_random_numbers : [optional] boolean (passed on to the choice function; simulate both graphs with the same random
+        streams instead of using the score cache)
+    susceptibility : [optional] array of floats (per-person susceptibility passed on to the choice function, see sri_mc)
+    sequential, batch_size, confidence : [optional] boolean, integer and float (passed on to the choice function; with
+        sequential=True min_epidemic_choice_fx adds replicates in batches of batch_size and stops as soon as its decision
+        is certain at the given confidence)
+    stats : [optional] boolean (record a ChainStats of the run and return it alongside the likely networks; it is also
+        passed to the choice function as stats=stats, which min_epidemic_choice_fx uses to time its simulations)
+    callback : [optional] function called as callback(step, stats) after every step of the chain (implies stats=True)
+    checkpoint : [optional] string (file to which the state of the chain is saved every checkpoint_every steps and after the
+        last step, along with the logs checkpoint + '.swaps' and checkpoint + '.visits' to which every checkpoint only
+        appends the new steps. The chain can be continued from it with resume_network_mc, giving the same result as an
+        uninterrupted run)
+    checkpoint_every : [optional] integer > 0 (number of steps between checkpoints)
+    model : [optional] CompartmentModel (passed on to the choice function to simulate instead of the SIR model)
+    result_cache : [optional] ScoreCache (passed on to the choice function, which keeps the scores of all simulated graphs
+        in it. It is not saved to its file by network_mc; call its save method or use it as a context manager)
+    output : [optional] 'dense', 'csr' or 'compact' (form of the returned networks, see initial_graph_generator. The chain
+        itself never builds a dense matrix, so 'csr' or 'compact' keep large networks within memory)
+    Keyword arguments the choice function does not accept are not passed to it.
 
 
     Outputs
     -------
-    likely_network : 2-D array of length n x n where n is the length of the input degree sequence (approximation of the most likely network)
+    likely_network : 2-D array of length n x n where n is the length of the input degree sequence (approximation of the most likely network),
+        or a CSR matrix or CompactGraph depending on output
+    stats : [only if stats or callback is given] ChainStats of the run
     '''
-    initial_graph = initial_graph_generator(degree_sequence)
-    current_state = initial_graph
-    print(current_state.shape)
-    graphs = []
-    counter = []
+    chain_stats = ChainStats() if stats or callback is not None else None
+    rng = np.random.default_rng(rng)
+    start = time.perf_counter()
+    if isinstance(degree_sequence, CompactGraph):
+        initial_graph = degree_sequence.to_csr()
+    else:
+        initial_graph = initial_graph_generator(degree_sequence, output = 'csr', rng = rng)
+    if chain_stats is not None:
+        chain_stats.add_time('initial_graph', time.perf_counter() - start)
+    settings = _chain_settings(transmission_probability, recovery_probability, occupation_probability, graph_percent, num_its_network_mc, num_its_sri_mc, cache_scores, common_random_numbers, model, output, sequential, batch_size, confidence)
+    counter, history = _network_chain(initial_graph, ages, choice_function, transmission_probability, recovery_probability, occupation_probability, num_its_network_mc, num_its_sri_mc, n_workers, rng, cache_scores, common_random_numbers, susceptibility, chain_stats, callback,
+        checkpoint = (checkpoint, checkpoint_every, settings) if checkpoint is not None else None, model = model, result_cache = result_cache, sequential = sequential, batch_size = batch_size, confidence = confidence)
+    return _likely_graphs(counter, history, graph_percent, chain_stats, output)
+
+def _chain_settings(transmission_probability, recovery_probability, occupation_probability, graph_percent, num_its_network_mc, num_its_sri_mc, cache_scores, common_random_numbers, model = None, output = 'dense', sequential = False, batch_size = 10, confidence = .95):
+    '''Settings of a chain saved in its checkpoints, as JSON-serializable python numbers (numpy ones are converted).'''
+
+    return dict(transmission_probability=float(transmission_probability), recovery_probability=float(recovery_probability), occupation_probability=float(occupation_probability),
+        graph_percent=float(graph_percent), num_its_network_mc=int(num_its_network_mc), num_its_sri_mc=int(num_its_sri_mc), cache_scores=bool(cache_scores),
+        common_random_numbers=bool(common_random_numbers), model=model.description() if model is not None else None, output=output,
+        sequential=bool(sequential), batch_size=int(batch_size), confidence=float(confidence))
+
+def resume_network_mc(checkpoint, choice_function, num_its_network_mc = None, n_workers = 1, stats = False, callback = None, checkpoint_every = 100, result_cache = None):
+    '''This function continues a network_mc chain from a checkpoint file written by network_mc(..., checkpoint=...). The
+    probabilities, ages, susceptibility and other settings of the original call are read from the file; the choice
+    function has to be passed again. The chain then runs until num_its_network_mc steps in total (by default the number
+    of the original call, and more to extend a finished chain), saving further checkpoints to the same file. Resuming
+    gives exactly the same likely networks as an uninterrupted run with the same rng, n_workers and choice function.
+
+    Inputs
+    ------
+    checkpoint : string (checkpoint file)
+    choice_function : function (the choice function of the original call)
+    num_its_network_mc : [optional] integer (total number of steps, counting those before the checkpoint)
+    n_workers, stats, callback, checkpoint_every, result_cache : [optional] as in network_mc. stats only covers the resumed
+        steps. The result is only the same as an uninterrupted run's if result_cache holds the same scores at this point
+
+    Outputs
+    -------
+    Same as network_mc'''
 
+    chain_stats = ChainStats() if stats or callback is not None else None
+    counter, history, settings = _resume_chain(checkpoint, choice_function, num_its_network_mc, n_workers, chain_stats, callback, checkpoint_every, result_cache = result_cache)
+    return _likely_graphs(counter, history, settings['graph_percent'], chain_stats, settings.get('output', 'dense'))
+
+def _resume_chain(checkpoint, choice_function, num_its_network_mc = None, n_workers = 1, stats = None, callback = None, checkpoint_every = 100, trace = None, result_cache = None):
+    '''Continues the chain saved in a checkpoint file until num_its_network_mc steps in total (by default the number of
+    the original call) and returns its visit counter, history and settings.'''
+
+    settings, ages, susceptibility, start = _read_checkpoint(checkpoint)
+    if num_its_network_mc is not None:
+        settings['num_its_network_mc'] = int(num_its_network_mc)
+    counter, history = _network_chain(None, ages, choice_function, settings['transmission_probability'], settings['recovery_probability'], settings['occupation_probability'],
+        settings['num_its_network_mc'], settings['num_its_sri_mc'], n_workers, start[-1], settings['cache_scores'], settings['common_random_numbers'], susceptibility, stats, callback,
+        checkpoint = (checkpoint, checkpoint_every, settings), start = start, trace = trace,
+        model = CompartmentModel(**settings['model']) if settings.get('model') is not None else None, result_cache = result_cache,
+        sequential = settings.get('sequential', False), batch_size = settings.get('batch_size', 10), confidence = settings.get('confidence', .95))
+    return counter, history, settings
+
+def _chain_block(checkpoint, choice_function, num_its_network_mc):
+    '''Process pool task of multi_chain_network_mc: advances the chain saved in checkpoint to num_its_network_mc steps,
+    saves it again and returns the _chain_statistics of the new steps.'''
+
+    trace = []
+    _resume_chain(checkpoint, choice_function, num_its_network_mc, checkpoint_every = num_its_network_mc, trace = trace)
+    return trace
+
+#statistics monitored by multi_chain_network_mc, in the order of _chain_statistics
+CHAIN_STATISTICS = ('score', 'assortativity')
+
+def _chain_statistics(swap_graph, degrees, score):
+    '''Summary statistics of a chain's current state: its score (the choice function's cached estimate, NaN if there is
+    none) and the degree assortativity of the graph (the correlation of the degrees at the two ends of an edge).'''
+
+    ends = degrees[swap_graph.edges].astype(np.float64)
+    ends = np.concatenate((ends, ends[:,::-1])) #both orientations of every edge
+    spread = ends[:,0].std()
+    assortativity = np.mean((ends[:,0] - ends[:,0].mean()) * (ends[:,1] - ends[:,1].mean())) / spread**2 if spread > 0 else 0.0
+    return (float(score) if score is not None else np.nan, assortativity)
+
+def multi_chain_network_mc(degree_sequence, ages, choice_function, transmission_probability, recovery_probability,occupation_probability,graph_percent,n_chains = 4, max_its_network_mc = 1000, num_its_sri_mc = 100, check_every = 50, r_hat_threshold = 1.05, min_ess = 100, n_processes = None, rng = None, cache_scores = True, common_random_numbers = False, susceptibility = None, model = None, output = 'dense', sequential = False, batch_size = 10, confidence = .95):
+    '''This function runs n_chains independent network_mc chains, each from its own random initial graph, in parallel
+    processes and stops them as soon as they agree. Every check_every steps the split R-hat and the effective sample size
+    of the chain score and of the degree assortativity (see CHAIN_STATISTICS) are computed over the second half of the
+    chains; the run stops once every statistic has r_hat below r_hat_threshold and ess of at least min_ess, or after
+    max_its_network_mc steps. The likely networks are then chosen from the visit counts of all chains together.
+
+    Between checks the chains are kept in checkpoint files (see network_mc) in a temporary directory, so any worker
+    process can advance any chain. choice_function must therefore be picklable (a module-level function). The score is
+    only available with cache_scores=True and a choice function that fills score_cache, such as min_epidemic_choice_fx;
+    otherwise only the assortativity is monitored.
+
+    Inputs
+    ------
+    Same as network_mc, plus
+    n_chains : [optional] integer > 1 (number of chains)
+    max_its_network_mc : [optional] integer (maximum number of steps per chain)
+    check_every : [optional] integer (number of steps per chain between convergence checks)
+    r_hat_threshold : [optional] float (largest accepted split R-hat)
+    min_ess : [optional] float (smallest accepted effective sample size, over all chains)
+    n_processes : [optional] integer (number of worker processes, defaults to n_chains; 1 runs the chains in this process)
+
+    Outputs
+    -------
+    likely_network : list of 2-D arrays (or CSR matrices or CompactGraphs, see output), as in network_mc
+    diagnostics : dictionary with 'converged' (boolean), 'steps' (steps per chain), 'r_hat' and 'ess' (dictionaries from
+        statistic name to value at the last check) and 'traces' (array of shape (n_chains, steps, len(CHAIN_STATISTICS)))'''
+
+    seeds = np.random.SeedSequence(np.random.default_rng(rng).integers(2**63, size=2)).spawn(n_chains)
+    settings = _chain_settings(transmission_probability, recovery_probability, occupation_probability, graph_percent, max_its_network_mc, num_its_sri_mc, cache_scores, common_random_numbers, model, output, sequential, batch_size, confidence)
+    n_processes = n_chains if n_processes is None else n_processes
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoints = [os.path.join(directory, 'chain_{}.npz'.format(k)) for k in range(n_chains)]
+        for checkpoint, seed in zip(checkpoints, seeds):
+            chain_rng = np.random.default_rng(seed)
+            swap_graph = EdgeSwapGraph.from_adjacency(initial_graph_generator(degree_sequence, output = 'csr', rng = chain_rng))
+            _write_checkpoint(checkpoint, settings, ages, susceptibility, 0, swap_graph, _ChainHistory(swap_graph), {}, {} if cache_scores else None, chain_rng)
+
+        executor = ProcessPoolExecutor(min(n_processes, n_chains)) if n_processes > 1 else None
+        try:
+            traces = [[] for k in range(n_chains)]
+            steps = 0
+            diagnostics = {'r_hat': {}, 'ess': {}, 'converged': False}
+            while steps < max_its_network_mc:
+                steps = min(steps + check_every, max_its_network_mc)
+                arguments = (checkpoints, [choice_function] * n_chains, [steps] * n_chains)
+                blocks = executor.map(_chain_block, *arguments) if executor is not None else map(_chain_block, *arguments)
+                for trace, block in zip(traces, blocks):
+                    trace.extend(block)
+                diagnostics = chain_diagnostics(np.array(traces), r_hat_threshold, min_ess)
+                if diagnostics['converged']:
+                    break
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        counter, graphs = {}, {}
+        chains = [_read_checkpoint(checkpoint)[-1] for checkpoint in checkpoints]
+        for chain in chains:
+            counter = _merge_visits(counter, chain[3])
+        likely = _most_visited(counter, graph_percent)
+        for chain in chains:
+            graphs = _merge_graphs(graphs, chain[2].materialize(likely, output))
+
+    diagnostics['steps'] = steps
+    diagnostics['traces'] = np.array(traces)
+    return [graphs[fingerprint] for fingerprint in likely], diagnostics
+
+def chain_diagnostics(traces, r_hat_threshold = 1.05, min_ess = 100):
+    '''Convergence diagnostics of chains of CHAIN_STATISTICS traces (array of shape (chains, steps, statistics)), computed
+    over the second half of every chain. Statistics that are NaN (e.g. an unavailable score) are skipped. Returns a
+    dictionary with 'r_hat', 'ess' and 'converged', as described in multi_chain_network_mc.'''
+
+    traces = np.asarray(traces, dtype=np.float64)
+    warm = traces[:, traces.shape[1] // 2:]
+    diagnostics = {'r_hat': {}, 'ess': {}}
+    for k, name in enumerate(CHAIN_STATISTICS):
+        draws = warm[:,:,k]
+        if draws.shape[1] < 4 or np.isnan(draws).any():
+            continue
+        diagnostics['r_hat'][name] = r_hat(draws)
+        diagnostics['ess'][name] = effective_sample_size(draws)
+    diagnostics['converged'] = len(diagnostics['r_hat']) > 0 and all(
+        diagnostics['r_hat'][name] < r_hat_threshold and diagnostics['ess'][name] >= min_ess for name in diagnostics['r_hat'])
+    return diagnostics
+
+def _split_chains(draws):
+    '''Splits every chain (row) into its first and second half, dropping the middle draw of odd-length chains.'''
+
+    half = draws.shape[1] // 2
+    return np.concatenate((draws[:, :half], draws[:, draws.shape[1] - half:]))
+
+def r_hat(draws):
+    '''Split R-hat (potential scale reduction factor) of an array of shape (chains, draws). Close to 1 when the chains
+    have mixed. Chains that are constant give 1 if they agree and infinity otherwise.'''
+
+    draws = _split_chains(np.asarray(draws, dtype=np.float64))
+    n = draws.shape[1]
+    within = draws.var(axis=1, ddof=1).mean()
+    between = draws.mean(axis=1).var(ddof=1) #B / n
+    if within == 0:
+        return 1.0 if between == 0 else np.inf
+    return float(np.sqrt(((n - 1) / n * within + between) / within))
+
+def effective_sample_size(draws):
+    '''Effective sample size of an array of shape (chains, draws), from the autocorrelations of the split chains summed
+    with Geyer's initial monotone sequence estimator. Constant chains count as independent draws.'''
+
+    draws = _split_chains(np.asarray(draws, dtype=np.float64))
+    m, n = draws.shape
+    centred = draws - draws.mean(axis=1, keepdims=True)
+    size = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(centred, n=size, axis=1)
+    autocovariance = np.fft.irfft(spectrum * np.conj(spectrum), n=size, axis=1)[:, :n] / n
+    within = autocovariance[:,0].mean() * n / (n - 1)
+    variance = (n - 1) / n * within + draws.mean(axis=1).var(ddof=1)
+    if variance == 0:
+        return float(m * n)
+    rho = 1 - (within - autocovariance.mean(axis=0)) / variance
+    rho[0] = 1
+
+    tau = -1.0
+    previous = np.inf
+    for t in range(0, n - 1, 2):
+        pair = min(rho[t] + rho[t + 1], previous) #monotone
+        if pair < 0:
+            break
+        tau += 2 * pair
+        previous = pair
+    return float(m * n / max(tau, 1.0 / np.log10(m * n)))
+
+def _likely_graphs(counter, history, graph_percent, stats, output = 'dense'):
+    '''Rebuilds the most visited graphs of a chain, returned with the stats if they are recorded.'''
+
+    start = time.perf_counter()
+    likely = _most_visited(counter, graph_percent)
+    graphs = history.materialize(likely, output)
+    likely_graphs = [graphs[fingerprint] for fingerprint in likely]
+    if stats is None:
+        return likely_graphs
+    stats.add_time('materialize', time.perf_counter() - start)
+    return likely_graphs, stats
+
+def _split_fingerprints(fingerprints):
+    '''128-bit fingerprints as two uint64 arrays (high and low halves).'''
+
+    return (np.array([fingerprint >> 64 for fingerprint in fingerprints], dtype=np.uint64),
+        np.array([fingerprint & _MASK_64 for fingerprint in fingerprints], dtype=np.uint64))
+
+def _join_fingerprints(high, low):
+    return [(int(h) << 64) | int(l) for h, l in zip(high, low)]
+
+#append-only logs kept next to a checkpoint file: the accepted swaps (k_1, k_2, edge_1, edge_2) and the visit counts
+#added since the previous checkpoint, with the swap log length at each graph's first visit
+_SWAP_LOG = '.swaps'
+_VISIT_LOG = '.visits'
+_visit_record = np.dtype([('high', np.uint64), ('low', np.uint64), ('visits', np.int64), ('first_seen', np.int64)])
+
+def _append_log(file_name, saved, records):
+    '''Appends records to a raw binary log after its first saved records, dropping anything an interrupted checkpoint
+    left after them, and returns the new number of records.'''
+
+    with open(file_name, 'ab'): #create the log if needed
+        pass
+    with open(file_name, 'r+b') as log_file:
+        log_file.truncate(saved * records.dtype.itemsize * (records.shape[1] if records.ndim == 2 else 1))
+        log_file.seek(0, os.SEEK_END)
+        records.tofile(log_file)
+        log_file.flush()
+        os.fsync(log_file.fileno())
+    return saved + len(records)
+
+def _write_checkpoint(path, settings, ages, susceptibility, step, swap_graph, history, counter, score_cache, rng):
+    '''Saves the state of a chain after step steps. The swaps accepted and the visits made since the previous checkpoint
+    of history are appended to the logs path + _SWAP_LOG and path + _VISIT_LOG, so a checkpoint only writes the new steps
+    and the edge arrays, never adjacency matrices or the whole history. The rest goes to an uncompressed .npz file,
+    written next to path and renamed over it, which holds the number of log records it covers. An interrupted checkpoint
+    therefore leaves the previous one intact, and log records past those numbers are ignored.'''
+
+    saved_swaps, saved_visits = history.saved
+    swaps = np.array([(k_1, k_2) + edge_1 + edge_2 for k_1, k_2, edge_1, edge_2 in history.swaps[saved_swaps:]], dtype=np.int64).reshape(-1, 6)
+    fingerprints = list(history.unsaved_visits) #in order of first visit, which breaks ties in _most_visited
+    visits = np.zeros(len(fingerprints), dtype=_visit_record)
+    visits['high'], visits['low'] = _split_fingerprints(fingerprints)
+    visits['visits'] = [history.unsaved_visits[fingerprint] for fingerprint in fingerprints]
+    visits['first_seen'] = [history.first_seen[fingerprint] for fingerprint in fingerprints]
+    num_swaps = _append_log(path + _SWAP_LOG, saved_swaps, swaps)
+    num_visits = _append_log(path + _VISIT_LOG, saved_visits, visits)
+
+    cache = list(score_cache.items()) if score_cache is not None else []
+    cache_high, cache_low = _split_fingerprints([fingerprint for fingerprint, _ in cache])
+    arrays = dict(
+        settings = np.array(json.dumps(settings)),
+        rng_state = np.array(json.dumps(rng.bit_generator.state)),
+        step = np.array(step),
+        num_people = np.array(swap_graph.num_people),
+        ages = np.asarray(ages),
+        edges = swap_graph.edges,
+        initial_edges = history.initial_edges,
+        num_swaps = np.array(num_swaps),
+        num_visits = np.array(num_visits),
+        cache_high = cache_high,
+        cache_low = cache_low,
+        cache_scores = np.array([score for _, score in cache]))
+    if susceptibility is not None:
+        arrays['susceptibility'] = np.asarray(susceptibility)
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, **arrays)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary, path)
+    history.saved = (num_swaps, num_visits)
+    history.unsaved_visits = {}
+
+def _read_checkpoint(path):
+    '''Inverse of _write_checkpoint. Returns the settings, ages, susceptibility and the chain state (step, swap graph,
+    history, visit counter, score cache and rng) to continue from.'''
+
+    with np.load(path) as arrays:
+        settings = json.loads(str(arrays['settings']))
+        state = json.loads(str(arrays['rng_state']))
+        bit_generator = getattr(np.random, state['bit_generator'])()
+        bit_generator.state = state
+        rng = np.random.Generator(bit_generator)
+
+        num_people = int(arrays['num_people'])
+        swap_graph = EdgeSwapGraph(arrays['edges'], num_people)
+        history = _ChainHistory(swap_graph)
+        history.initial_edges = arrays['initial_edges']
+        num_swaps, num_visits = int(arrays['num_swaps']), int(arrays['num_visits'])
+        score_cache = dict(zip(_join_fingerprints(arrays['cache_high'], arrays['cache_low']), arrays['cache_scores'])) if settings['cache_scores'] else None
+        ages = arrays['ages']
+        susceptibility = arrays['susceptibility'] if 'susceptibility' in arrays else None
+        step = int(arrays['step'])
+
+    swaps = np.fromfile(path + _SWAP_LOG, dtype=np.int64, count=6 * num_swaps).reshape(-1, 6)
+    history.swaps = [(k_1, k_2, (a, b), (c, d)) for k_1, k_2, a, b, c, d in swaps.tolist()]
+    visits = np.fromfile(path + _VISIT_LOG, dtype=_visit_record, count=num_visits)
+    counter = {}
+    for fingerprint, count, first_seen in zip(_join_fingerprints(visits['high'], visits['low']), visits['visits'].tolist(), visits['first_seen'].tolist()):
+        counter[fingerprint] = counter.get(fingerprint, 0) + count
+        history.first_seen.setdefault(fingerprint, first_seen)
+    history.saved = (num_swaps, num_visits)
+    return settings, ages, susceptibility, (step, swap_graph, history, counter, score_cache, rng)
+
+def _supported_keywords(function, **keywords):
+    '''Returns the subset of keywords that function accepts, so that optional features are only passed on to choice
+    functions that know about them.'''
+
+    parameters = inspect.signature(function).parameters
+    if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters.values()):
+        return keywords
+    return dict((name, value) for name, value in keywords.items() if name in parameters)
+
+def _network_chain(initial_graph, ages, choice_function, transmission_probability, recovery_probability, occupation_probability, num_its_network_mc, num_its_sri_mc, n_workers = 1, rng = None, cache_scores = True, common_random_numbers = False, susceptibility = None, stats = None, callback = None, checkpoint = None, start = None, trace = None, model = None, result_cache = None, sequential = False, batch_size = 10, confidence = .95):
+    '''Runs one Metropolis-Hastings chain of network_mc starting from initial_graph. Returns a dictionary from the fingerprint
+    of every distinct graph visited to the number of steps spent in it, and the _ChainHistory needed to rebuild those graphs.
+    Candidates are passed to the choice function as CSR matrices; a step counts as accepted when the choice function returns
+    the candidate object itself. The chain's rng, process pool and score cache are passed to the choice function as keyword
+    arguments, for those it accepts. If a ChainStats is given, the time spent in every phase of a step is added to it and
+    callback(step, stats) is called after each step. checkpoint is an optional (path, checkpoint_every, settings) tuple
+    for _write_checkpoint, and start an optional chain state returned by _read_checkpoint to continue from instead of
+    initial_graph. If trace is a list, the _chain_statistics of the current state are appended to it after every step.'''
+
+    if start is None:
+        first_step = 0
+        counter = {}
+        current_state = initial_graph
+        swap_graph = EdgeSwapGraph.from_adjacency(initial_graph) #candidates are generated by swapping edges in place
+        history = _ChainHistory(swap_graph)
+        score_cache = {} if cache_scores else None
+    else:
+        first_step, swap_graph, history, counter, score_cache, rng = start
+        current_state = swap_graph.to_csr()
+    if trace is not None:
+        degrees = np.bincount(swap_graph.edges.ravel(), minlength=swap_graph.num_people) #kept by every swap
 
-    for i in range(num_its_network_mc):
-        #generating next graph
-        candidate_state = swap_function(current_state)
-        current_state = choice_function(candidate_state,current_state,ages, transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc)
+    rng = np.random.default_rng(rng)
+    executor = ProcessPoolExecutor(n_workers) if n_workers > 1 else None #one pool for the whole chain
+    choice_kwargs = _supported_keywords(choice_function, rng=rng, executor=executor, n_workers=n_workers, score_cache=score_cache, common_random_numbers=common_random_numbers)
+    if susceptibility is not None:
+        choice_kwargs.update(_supported_keywords(choice_function, susceptibility=susceptibility))
+    if stats is not None:
+        choice_kwargs.update(_supported_keywords(choice_function, stats=stats))
+    if model is not None:
+        choice_kwargs.update(_supported_keywords(choice_function, model=model))
+    if result_cache is not None:
+        choice_kwargs.update(_supported_keywords(choice_function, result_cache=result_cache))
+    if sequential:
+        choice_kwargs.update(_supported_keywords(choice_function, sequential=sequential, batch_size=batch_size, confidence=confidence))
 
-        #check if the graph is already in the list. if not, append it to the list
-        identical_graph_found = False
-        for graph in range(len(graphs)):
+    try:
+        for i in range(first_step, num_its_network_mc):
+            if stats is not None:
+                step_start = time.perf_counter()
+                rejected_swaps = swap_graph.rejected_swaps
+            #generating next graph
+            swap = swap_graph.swap(rng)
+            candidate_state = swap_graph.to_csr()
+            if stats is not None:
+                choice_start = time.perf_counter()
+                stats.add_time('swap', choice_start - step_start)
+                stats.swap_rejections += swap_graph.rejected_swaps - rejected_swaps
+            chosen_state = choice_function(candidate_state,current_state,ages, transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,**choice_kwargs)
+            if stats is not None:
+                bookkeeping_start = time.perf_counter()
+                stats.add_time('choice', bookkeeping_start - choice_start)
+                stats.steps += 1
+                stats.accepted += chosen_state is candidate_state
+            if chosen_state is candidate_state:
+                current_state = candidate_state
+                history.accepted(swap_graph, swap)
+            else: #rejected, back to the current state
+                swap_graph.undo(swap)
 
-            if np.allclose(graphs[graph],current_state) == True: 
-                counter[graph] += 1
-                identical_graph_found = True
+            fingerprint = swap_graph.fingerprint()
+            counter[fingerprint] = counter.get(fingerprint, 0) + 1
+            history.visited(fingerprint)
+            if score_cache is not None: #only the current state's score is needed for the next step
+                current_score = score_cache.get(fingerprint)
+                score_cache.clear()
+                if current_score is not None:
+                    score_cache[fingerprint] = current_score
+            if trace is not None:
+                trace.append(_chain_statistics(swap_graph, degrees, score_cache.get(fingerprint) if score_cache is not None else None))
+            if checkpoint is not None and ((i + 1) % checkpoint[1] == 0 or i + 1 == num_its_network_mc):
+                _write_checkpoint(checkpoint[0], checkpoint[2], ages, susceptibility, i + 1, swap_graph, history, counter, score_cache, rng)
+            if stats is not None:
+                stats.add_time('bookkeeping', time.perf_counter() - bookkeeping_start)
+                if callback is not None:
+                    callback(i, stats)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-        if identical_graph_found == False:
-            graphs.append(current_state)
-            counter.append(1)
+    return counter, history
+
+class ChainStats(object):
+    '''Instrumentation of a network_mc run, returned by network_mc(..., stats=True) and passed to its callback.
+
+    Attributes
+    ----------
+
+    steps : integer (chain steps taken so far)
+    accepted : integer (steps in which the candidate graph was accepted)
+    swap_rejections : integer (swap proposals rejected because they would have created a self-edge or repeated edge)
+    phase_time : dictionary from phase name to wall time in seconds. The phases are 'initial_graph', 'swap' (proposing the
+        candidate), 'choice' (the choice function, mostly simulation), 'bookkeeping' (fingerprints, visit counts, history,
+        score cache and checkpoints) and 'materialize' (rebuilding the likely graphs)
+    simulation_time : float (seconds spent simulating, as reported by the choice function)
+    simulated_days : integer (days simulated by the choice function, counting every replicate)
+    simulated_node_days : integer (simulated_days times the number of people)'''
+
+    def __init__(self):
+        self.steps = 0
+        self.accepted = 0
+        self.swap_rejections = 0
+        self.phase_time = {}
+        self.simulation_time = 0.0
+        self.simulated_days = 0
+        self.simulated_node_days = 0
+
+    def add_time(self, phase, seconds):
+        self.phase_time[phase] = self.phase_time.get(phase, 0.0) + seconds
+
+    def add_simulation(self, seconds, days, num_people):
+        '''Records a simulation of the given number of days (summed over replicates) on a network of num_people.'''
+
+        self.simulation_time += seconds
+        self.simulated_days += days
+        self.simulated_node_days += days * num_people
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.steps if self.steps else float('nan')
+
+    @property
+    def days_per_second(self):
+        return self.simulated_days / self.simulation_time if self.simulation_time else float('nan')
+
+    @property
+    def node_days_per_second(self):
+        return self.simulated_node_days / self.simulation_time if self.simulation_time else float('nan')
+
+    def __repr__(self):
+        phases = ', '.join('{}={:.3g}s'.format(phase, seconds) for phase, seconds in self.phase_time.items())
+        return 'ChainStats(steps={}, acceptance_rate={:.3g}, swap_rejections={}, days_per_second={:.3g}, {})'.format(
+            self.steps, self.acceptance_rate, self.swap_rejections, self.days_per_second, phases)
+
+class _ChainHistory(object):
+    '''Compact record of the graphs visited by a chain: the initial edge array, the log of accepted swaps and, for every
+    distinct graph, the length of the log when it was first visited. Any visited graph can be rebuilt by replaying the log,
+    so each step costs a constant amount of memory instead of a copy of the graph. It also tracks what the checkpoint logs
+    of _write_checkpoint already hold.'''
+
+    def __init__(self, swap_graph):
+        self.initial_edges = swap_graph.edges.copy()
+        self.num_people = swap_graph.num_people
+        self.swaps = []
+        self.first_seen = {}
+        self.saved = (0, 0) #numbers of swap and visit records in the checkpoint logs
+        self.unsaved_visits = {} #visits since the last checkpoint
+
+    def accepted(self, swap_graph, swap):
+        k_1, k_2 = swap[0], swap[1]
+        self.swaps.append((k_1, k_2, tuple(swap_graph.edges[k_1].tolist()), tuple(swap_graph.edges[k_2].tolist())))
+
+    def visited(self, fingerprint):
+        if fingerprint not in self.first_seen:
+            self.first_seen[fingerprint] = len(self.swaps)
+        self.unsaved_visits[fingerprint] = self.unsaved_visits.get(fingerprint, 0) + 1
+
+    def materialize(self, fingerprints, output = 'dense'):
+        '''Returns a dictionary from each of the given fingerprints visited by this chain to its graph, in the form named by
+        output (see initial_graph_generator).'''
+
+        positions = sorted((self.first_seen[fingerprint], fingerprint) for fingerprint in fingerprints if fingerprint in self.first_seen)
+        edges = self.initial_edges.copy()
+        applied = 0
+        graphs = {}
+        for position, fingerprint in positions:
+            for k_1, k_2, edge_1, edge_2 in self.swaps[applied:position]:
+                edges[k_1] = edge_1
+                edges[k_2] = edge_2
+            applied = max(applied, position)
+            graphs[fingerprint] = _graph_output(edges.copy(), self.num_people, output)
+        return graphs
+
+def _merge_visits(counter_a, counter_b):
+    '''Combines two fingerprint visit counters, e.g. from two independent chains, adding up the counts of graphs that appear
+    in both.'''
+
+    counter = dict(counter_a)
+    for fingerprint, visits in counter_b.items():
+        counter[fingerprint] = counter.get(fingerprint, 0) + visits
+    return counter
+
+def _merge_graphs(graphs_a, graphs_b):
+    '''Combines two fingerprint to graph dictionaries.'''
+
+    graphs = dict(graphs_b)
+    graphs.update(graphs_a)
+    return graphs
+
+def _most_visited(counter, graph_percent):
+    '''Returns the fingerprints of the graph_percent fraction (at least one) of the distinct graphs with the highest visit
+    counts, most visited first. Ties keep the order in which the graphs were first visited.'''
 
     #calculating number of graphs to return
     uniques = len(counter)
@@ -169,88 +1931,514 @@ def network_mc(degree_sequence, ages, choice_function, transmission_probability,
     if returned == 0:
         returned = 1 
 
-    #sorting by counter value and selecting the correct graphs
-    #source for zipping: http://stackoverflow.com/questions/6618515/sorting-list-based-on-values-from-another-list
-    graph_and_counter = zip(counter,graphs)
-    likely_graphs = [graph for counter, graph in sorted(graph_and_counter,reverse = True, key = lambda count: count[0])]    
-    return likely_graphs[:returned]
+    return sorted(counter, reverse = True, key = lambda fingerprint: counter[fingerprint])[:returned]
+
+class ScoreCache(object):
+    '''Bounded least-recently-used store of simulation scores, kept across the steps of a chain and (with a path) between runs. It maps
+    (graph fingerprint, parameters, replicate count) to the estimated score of the graph, i.e. the final number of
+    susceptible people summed over the replicates, and the variance of that estimate. Pass it to min_epidemic_choice_fx or
+    network_mc as result_cache= so that graphs seen before are not simulated again. The parameters are a string made by
+    score_parameters from everything else the simulations depend on. Once more than max_entries scores are stored the least
+    recently used ones are dropped.
+
+    With a path the scores saved there by an earlier cache are loaded on creation, and save() (also called by close() and
+    when used as a context manager) writes them back, so repeated jobs with the same configuration start warm.
+
+    Inputs
+    ------
+
+    max_entries : [optional] integer > 0 (number of scores kept)
+    path : [optional] string (.npz file the scores are loaded from and saved to)'''
+
+    def __init__(self, max_entries = 2**16, path = None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() #least recently used first
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def get(self, fingerprint, parameters, n_replicates):
+        '''Returns the (score, variance) stored for a graph, or None.'''
+
+        key = (fingerprint, parameters, n_replicates)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, fingerprint, parameters, n_replicates, score, variance):
+        key = (fingerprint, parameters, n_replicates)
+        self._entries[key] = (float(score), float(variance))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def save(self):
+        if self.path is None:
+            return
+        keys = list(self._entries)
+        parameters, parameter_index = np.unique(np.array([key[1] for key in keys] or [''], dtype=str), return_inverse=True)
+        high, low = _split_fingerprints([key[0] for key in keys])
+        values = np.array(list(self._entries.values()), dtype=np.float64).reshape(-1, 2)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as cache_file: #replace the old file atomically
+            np.savez(cache_file, fingerprint_high=high, fingerprint_low=low, parameters=parameters, parameter_index=parameter_index[:len(keys)],
+                n_replicates=np.array([key[2] for key in keys], dtype=np.int64), score=values[:,0], variance=values[:,1])
+            cache_file.flush()
+            os.fsync(cache_file.fileno())
+        os.replace(cache_file.name, self.path)
+
+    def _load(self):
+        with np.load(self.path) as arrays:
+            fingerprints = _join_fingerprints(arrays['fingerprint_high'], arrays['fingerprint_low'])
+            parameters = [str(parameter) for parameter in arrays['parameters']]
+            for fingerprint, index, n_replicates, score, variance in zip(fingerprints, arrays['parameter_index'], arrays['n_replicates'], arrays['score'], arrays['variance']):
+                self.put(fingerprint, parameters[index], int(n_replicates), score, variance)
+
+    def close(self):
+        self.save()
+
+    def __enter__(self):
+        return self
 
-def min_epidemic_choice_fx(candidate_array,current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib=0):
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return 'ScoreCache({} of {} entries, {} hits, {} misses)'.format(len(self), self.max_entries, self.hits, self.misses)
+
+def _digest(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+def score_parameters(ages, transmission_probability, recovery_probability, occupation_probability, num_its_sri_mc, init_distrib = 0, susceptibility = None, model = None, sequential = False):
+    '''The parameters part of a ScoreCache key: a string identifying everything other than the graph and the number of
+    replicates that the scores of min_epidemic_choice_fx depend on. The ages only enter through their number, and the
+    initial infections and susceptibilities through a hash. Scores of sequential tests that stopped before n_replicates
+    replicates get their own keys (sequential=True).'''
+
+    num_people = len(ages)
+    return json.dumps(dict(num_people=num_people, transmission_probability=float(transmission_probability), recovery_probability=float(recovery_probability),
+        occupation_probability=float(occupation_probability), num_its=int(num_its_sri_mc), infected=_digest(_initial_infected(init_distrib, num_people)),
+        susceptibility=_digest(_susceptibility_vector(susceptibility, num_people)) if susceptibility is not None else None,
+        model=model.description() if model is not None else None, sequential=bool(sequential)), sort_keys=True)
+
+def _cached_score(result_cache, fingerprint, parameters, n_replicates):
+    '''The first score found in result_cache for the graph under one of the given parameters, or None. Only the last
+    probe goes through get, so a lookup counts as one hit or one miss.'''
+
+    for parameter in parameters[:-1]:
+        if (fingerprint, parameter, n_replicates) in result_cache:
+            return result_cache.get(fingerprint, parameter, n_replicates)[0]
+    cached = result_cache.get(fingerprint, parameters[-1], n_replicates)
+    return cached[0] if cached is not None else None
+
+def _score_variance(draws, n_replicates):
+    '''Variance of the score (n_replicates times the mean of the draws) estimated from draws.'''
+
+    if len(draws) < 2:
+        return np.inf
+    return n_replicates**2 * np.var(draws, ddof=1) / len(draws)
+
+def min_epidemic_choice_fx(candidate_array,current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib=0,rng=None,n_replicates=100,n_workers=1,executor=None,score_cache=None,common_random_numbers=False,susceptibility=None,stats=None,sequential=False,batch_size=10,confidence=.95,model=None,result_cache=None):
     '''This is a built-in function that chooses the next graph for the Network MC using the Metropolis-Hastings algorithm for MCMC.
     Because the MCMC occurs via constrained swapping, q(i|j) = q(j|i) where q is the candidate-generating function and i and j
     are potential arrays. Thus, the transition probability is min(pi_j / pi_i, 1) where pi_j / pi_j is a function of choice. Here,
-    we set pi_j / pi_i to equal num_susceptible_j / num_susceptible_i after all iterations.'''
-
-    avg_num_susceptible_j = 0
-    avg_num_susceptible_i = 0
-    for i in range(100): #collecting average numbers of susceptible people after repeated evolution of network 
-        num_susceptible_j,_,_ = sri_mc(candidate_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its=num_its_sri_mc,init_distrib=init_distrib)
-        num_susceptible_i,_,_ = sri_mc(current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its=num_its_sri_mc,init_distrib=init_distrib)
-        avg_num_susceptible_j += num_susceptible_j[num_its_sri_mc]
-        avg_num_susceptible_i += num_susceptible_i[num_its_sri_mc]
-    alpha = min(float(avg_num_susceptible_j)/avg_num_susceptible_i,1)
-    u = np.random.random_sample()
+    we set pi_j / pi_i to equal num_susceptible_j / num_susceptible_i after all iterations, averaged over n_replicates
+    simulations of each graph (run as one sri_mc_ensemble call per graph). rng is an optional numpy.random.Generator
+    (or integer seed) shared by the simulations and the acceptance draw.
+
+    With n_workers > 1 the replicates are spread over a pool of worker processes, each running its share as one ensemble
+    with an independent random stream. Pass an existing concurrent.futures executor (with n_workers set to its number of
+    workers) to reuse one pool across calls; otherwise a pool is created for this call only.
+
+    score_cache is an optional dictionary from graph_fingerprint to the summed final number of susceptible people. When the
+    current graph is found in it its score is reused instead of simulated again, and the scores of both graphs are stored
+    in it, so a chain only simulates its candidates. Reusing the current state's estimate keeps the chain a valid
+    (pseudo-marginal) Metropolis-Hastings chain. With common_random_numbers=True both graphs are instead simulated with the
+    same random streams, which lowers the variance of the ratio; the cache is not used then. susceptibility is an optional
+    per-person vector passed on to the simulations (see sri_mc). If a ChainStats is passed as stats, the time and number of
+    days of every simulation are recorded in it.
+
+    With sequential=True the uniform u of the acceptance test is drawn before any simulation and replicates are added in
+    batches of batch_size. After every batch a normal confidence interval (at level confidence) of the ratio
+    num_susceptible_j / num_susceptible_i is computed, and the step is decided as soon as the interval lies entirely above
+    or below u, or once n_replicates replicates (the hard cap) have been run. Clear-cut steps then only need a few
+    batches. The test is approximate: a decision is wrong with probability of order 1 - confidence.
+
+    model is an optional CompartmentModel (e.g. seir_model(...)) to simulate instead of the SIR model given by the three
+    probabilities; pi_j / pi_i is then the ratio of the numbers of people left in its first state.
+
+    result_cache is an optional ScoreCache. Unlike score_cache, which only carries the current state's score from one step
+    to the next, it keeps the scores of every graph simulated (up to its size) and under which parameters, so a graph
+    seen before, in this chain, another one or an earlier run, is never simulated again. Each graph is then scored by a
+    single estimate, which makes the chain target those fixed estimates rather than averaging over fresh ones; the
+    variance stored with each score shows how noisy they are. It is not used with common_random_numbers=True.'''
+
+    rng = np.random.default_rng(rng)
+    if executor is None and n_workers > 1: #pool for this call only
+        with ProcessPoolExecutor(n_workers) as executor:
+            return min_epidemic_choice_fx(candidate_array,current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib=init_distrib,rng=rng,n_replicates=n_replicates,n_workers=n_workers,executor=executor,score_cache=score_cache,common_random_numbers=common_random_numbers,susceptibility=susceptibility,stats=stats,sequential=sequential,batch_size=batch_size,confidence=confidence,model=model,result_cache=result_cache)
+    if sequential:
+        return _sequential_choice(candidate_array,current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,rng,n_replicates,n_workers,executor,score_cache,common_random_numbers,susceptibility,stats,batch_size,confidence,model,result_cache)
+
+    #collecting average numbers of susceptible people after repeated evolution of network 
+    if common_random_numbers:
+        seed = rng.integers(2**63)
+        avg_num_susceptible_j = _final_susceptible(candidate_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,n_replicates,executor,n_workers,np.random.default_rng(seed),susceptibility,stats,model)
+        avg_num_susceptible_i = _final_susceptible(current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,n_replicates,executor,n_workers,np.random.default_rng(seed),susceptibility,stats,model)
+    else:
+        parameters = score_parameters(ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,susceptibility,model) if result_cache is not None else None
+        avg_num_susceptible_j = _cached_final_susceptible(result_cache,parameters,candidate_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,n_replicates,executor,n_workers,rng,susceptibility,stats,model)
+        current_key = graph_fingerprint(current_array) if score_cache is not None else None
+        if current_key is not None and current_key in score_cache:
+            avg_num_susceptible_i = score_cache[current_key]
+        else:
+            avg_num_susceptible_i = _cached_final_susceptible(result_cache,parameters,current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,n_replicates,executor,n_workers,rng,susceptibility,stats,model)
+        if score_cache is not None:
+            score_cache[current_key] = avg_num_susceptible_i
+            score_cache[graph_fingerprint(candidate_array)] = avg_num_susceptible_j
+
+    if avg_num_susceptible_i == 0: #nobody left on the current graph, so the candidate cannot be worse
+        alpha = 1
+    else:
+        alpha = min(float(avg_num_susceptible_j)/avg_num_susceptible_i,1)
+    u = rng.random()
     if u <= alpha: 
         return candidate_array
     else:
         return current_array
 
+def _final_susceptible(graph, ages, transmission_probability, recovery_probability, occupation_probability, num_its, init_distrib, n_replicates, executor, n_workers, rng, susceptibility = None, stats = None, model = None):
+    '''Returns the final number of susceptible people summed over n_replicates simulations of graph, see
+    _final_susceptible_draws.'''
+
+    return _final_susceptible_draws(graph,ages,transmission_probability,recovery_probability,occupation_probability,num_its,init_distrib,n_replicates,executor,n_workers,rng,susceptibility,stats,model).sum()
+
+def _cached_final_susceptible(result_cache, parameters, graph, ages, transmission_probability, recovery_probability, occupation_probability, num_its, init_distrib, n_replicates, executor, n_workers, rng, susceptibility = None, stats = None, model = None):
+    '''_final_susceptible, looked up in and stored into a ScoreCache if one is given.'''
+
+    if result_cache is None:
+        return _final_susceptible(graph,ages,transmission_probability,recovery_probability,occupation_probability,num_its,init_distrib,n_replicates,executor,n_workers,rng,susceptibility,stats,model)
+    fingerprint = graph_fingerprint(graph)
+    cached = result_cache.get(fingerprint, parameters, n_replicates)
+    if cached is not None:
+        return cached[0]
+    draws = _final_susceptible_draws(graph,ages,transmission_probability,recovery_probability,occupation_probability,num_its,init_distrib,n_replicates,executor,n_workers,rng,susceptibility,stats,model)
+    result_cache.put(fingerprint, parameters, n_replicates, draws.sum(), _score_variance(draws, n_replicates))
+    return draws.sum()
+
+def _final_susceptible_draws(graph, ages, transmission_probability, recovery_probability, occupation_probability, num_its, init_distrib, n_replicates, executor, n_workers, rng, susceptibility = None, stats = None, model = None):
+    '''Returns the final number of susceptible people of each of n_replicates simulations of graph, run in the executor's
+    worker processes if one is given and as a single ensemble otherwise. With a CompartmentModel the people left in its
+    first state are counted instead. The simulation is recorded in stats if given.'''
+
+    start = time.perf_counter() if stats is not None else None
+    if executor is not None:
+        draws = _parallel_final_susceptible_draws([graph],init_distrib,transmission_probability,recovery_probability,occupation_probability,num_its,n_replicates,executor,n_workers,rng,susceptibility,model)[0]
+    elif model is not None:
+        draws = model_mc_ensemble(graph,model,init_distrib=init_distrib,num_its=num_its,n_replicates=n_replicates,rng=rng,susceptibility=susceptibility)[0][:,num_its]
+    else:
+        num_susceptible,_,_ = sri_mc_ensemble(graph,ages,transmission_probability,recovery_probability,occupation_probability,num_its=num_its,init_distrib=init_distrib,n_replicates=n_replicates,rng=rng,susceptibility=susceptibility)
+        draws = num_susceptible[:,num_its]
+    if stats is not None:
+        stats.add_simulation(time.perf_counter() - start, num_its * n_replicates, len(ages))
+    return draws
+
+def _ratio_estimate(candidate_draws, current_draws, paired = False):
+    '''Ratio of the mean final numbers of susceptible people of the candidate and the current graph, with its delta-method
+    standard error. Either set of draws may be a single float (a cached mean, taken as exact). Paired draws (common random
+    numbers) use the variance of the per-replicate residuals instead of treating the two samples as independent. The
+    error is infinite with fewer than two draws. If the current mean is 0 the ratio is infinite with error 0, so the
+    candidate is accepted straight away as in the fixed-size test.'''
+
+    candidate_draws = np.asarray(candidate_draws, dtype=np.float64)
+    current_draws = np.asarray(current_draws, dtype=np.float64)
+    candidate_mean, current_mean = candidate_draws.mean(), current_draws.mean()
+    if current_mean == 0: #nobody left on the current graph, so the candidate cannot be worse
+        return np.inf, 0.
+    ratio = candidate_mean / current_mean
+    sampled = [draws for draws in (candidate_draws, current_draws) if draws.ndim]
+    if not sampled:
+        return ratio, 0.
+    if min(len(draws) for draws in sampled) < 2:
+        return ratio, np.inf
+    if paired:
+        variance = np.var(candidate_draws - ratio * current_draws, ddof=1) / len(candidate_draws)
+    else:
+        variance = 0.
+        if candidate_draws.ndim:
+            variance += np.var(candidate_draws, ddof=1) / len(candidate_draws)
+        if current_draws.ndim:
+            variance += ratio**2 * np.var(current_draws, ddof=1) / len(current_draws)
+    return ratio, np.sqrt(variance) / current_mean
+
+def _sequential_choice(candidate_array,current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,rng,n_replicates,n_workers,executor,score_cache,common_random_numbers,susceptibility,stats,batch_size,confidence,model,result_cache=None):
+    '''Sequential version of the acceptance test of min_epidemic_choice_fx, see its docstring.'''
+
+    u = rng.random() #drawn first, so the simulations can stop as soon as the decision is clear
+    z = ss.norm.ppf(.5 + confidence / 2)
+    current_key = graph_fingerprint(current_array) if score_cache is not None and not common_random_numbers else None
+    cached_score = score_cache.get(current_key) if current_key is not None else None
+    cached_candidate = None
+    if result_cache is not None and not common_random_numbers:
+        #scores of all n_replicates replicates are shared with the fixed test, those of stopped tests kept apart
+        parameters = [score_parameters(ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,susceptibility,model,sequential=sequential) for sequential in (False, True)]
+        fingerprints = graph_fingerprint(candidate_array), graph_fingerprint(current_array)
+        cached_candidate = _cached_score(result_cache, fingerprints[0], parameters, n_replicates)
+        if cached_score is None:
+            cached_score = _cached_score(result_cache, fingerprints[1], parameters, n_replicates)
+    candidate_draws, current_draws = [], []
+    replicates = 0
+
+    while True:
+        batch = min(batch_size, n_replicates - replicates)
+        replicates += batch
+        if common_random_numbers:
+            seed = rng.integers(2**63)
+            candidate_draws.extend(_final_susceptible_draws(candidate_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,batch,executor,n_workers,np.random.default_rng(seed),susceptibility,stats,model))
+            current_draws.extend(_final_susceptible_draws(current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,batch,executor,n_workers,np.random.default_rng(seed),susceptibility,stats,model))
+        else:
+            if cached_candidate is None:
+                candidate_draws.extend(_final_susceptible_draws(candidate_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,batch,executor,n_workers,rng,susceptibility,stats,model))
+            if cached_score is None:
+                current_draws.extend(_final_susceptible_draws(current_array,ages,transmission_probability,recovery_probability,occupation_probability,num_its_sri_mc,init_distrib,batch,executor,n_workers,rng,susceptibility,stats,model))
+        ratio, error = _ratio_estimate(candidate_draws if cached_candidate is None else float(cached_candidate) / n_replicates,
+            current_draws if cached_score is None else float(cached_score) / n_replicates, common_random_numbers)
+        if replicates >= n_replicates or ratio - z * error > u or ratio + z * error < u:
+            break
+
+    #scores are kept on the scale of n_replicates replicates
+    candidate_score = cached_candidate if cached_candidate is not None else np.mean(candidate_draws) * n_replicates
+    current_score = cached_score if cached_score is not None else np.mean(current_draws) * n_replicates
+    if current_key is not None:
+        score_cache[current_key] = current_score
+        score_cache[graph_fingerprint(candidate_array)] = candidate_score
+    if result_cache is not None and not common_random_numbers:
+        for fingerprint, score, draws in zip(fingerprints, (candidate_score, current_score), (candidate_draws, current_draws)):
+            if draws: #only graphs simulated here are stored
+                result_cache.put(fingerprint, parameters[len(draws) < n_replicates], n_replicates, score, _score_variance(draws, n_replicates))
+    if u <= min(ratio, 1):
+        return candidate_array
+    else:
+        return current_array
+
 def age(ages,transmission_probability,recovery_probability):
     '''This function returns the effects of age on probability of getting a disease. This is essentially a guess function 
-    for the effects of age, but literature suggests those over 65 and children are more prone to disease.'''
+    for the effects of age, but literature suggests those over 65 and children are more prone to disease. Over 64 and
+    6 to 12 year olds get +5%, 5 and under +10% and everyone else (including 13 year olds) -5%, in units of
+    transmission_probability * recovery_probability. Works on arrays of any size. Raises a ValueError for missing (NaN) or
+    infinite ages, which would otherwise fall into the 5 and under group.'''
 
-    age_effects = []
-    for i in range(len(ages)):
-        if ages[i] > 64:
-            age_effects.append(.05 * transmission_probability *recovery_probability)
-        elif ages[i] <=64 and ages[i] > 13:
-            age_effects.append(-.05 * transmission_probability * recovery_probability)
-        elif ages[i] <=12 and ages[i] > 5: 
-            age_effects.append(.05 * transmission_probability * recovery_probability)
-        elif ages[i] <= 5:
-            age_effects.append(.10 * transmission_probability * recovery_probability)
+    ages = np.asarray(ages, dtype=np.float64)
+    if not np.all(np.isfinite(ages)):
+        raise ValueError('ages must be finite numbers')
+    age_effects = np.select([ages > 64, ages > 12, ages > 5], [.05, -.05, .05], default=.10)
+    return age_effects * transmission_probability * recovery_probability
 
-    return age_effects
+def age_susceptibility(ages):
+    '''Per-person susceptibility vector for sri_mc built from age: 1 plus the relative age effect of age().'''
 
-def swap_function(graph):
-    '''This function swaps two edges on a given graph.
+    return 1 + age(ages, 1, 1)
 
-    Input
-    -----
+def _is_edge_list(graph):
+    '''Dense (m, 2) arrays are read as edge lists rather than adjacency matrices. A 2 x 2 array is only read as an
+    adjacency matrix if it is symmetric, so a list of two edges such as [[0, 5], [3, 4]] is an edge list.'''
+
+    if sp.issparse(graph) or isinstance(graph, (EdgeSwapGraph, CompactGraph)) or np.ndim(graph) != 2 or np.shape(graph)[1] != 2:
+        return False
+    if np.shape(graph)[0] == 2:
+        array = np.asarray(graph)
+        return array[0,1] != array[1,0]
+    return True
+
+def _edge_array(graph):
+    '''Returns the (m, 2) edge array and number of people of a dense or scipy.sparse adjacency matrix (entries are edge
+    multiplicities, the diagonal counts self-edges once each), an (m, 2) edge list, a CompactGraph or an EdgeSwapGraph.'''
+
+    if isinstance(graph, (EdgeSwapGraph, CompactGraph)):
+        return graph.edges, graph.num_people
+    if _is_edge_list(graph):
+        edges = np.asarray(graph, dtype=np.int64)
+        return edges, int(edges.max()) + 1 if len(edges) else 0
+    if sp.issparse(graph):
+        upper = sp.triu(graph).tocoo()
+        rows, cols, counts = upper.row, upper.col, upper.data
+    else:
+        array = np.asarray(graph)
+        rows, cols = np.nonzero(np.triu(array))
+        counts = array[rows, cols]
+    return np.repeat(np.column_stack((rows, cols)), np.rint(counts).astype(np.int64), axis=0), graph.shape[0]
+
+#constants of the splitmix64 finalizer used to hash edges, and the salt of the second hash lane
+_MIX_CONSTANTS = (0x9E3779B97F4A7C15, 0xBF58476D1CE4E5B9, 0x94D049BB133111EB)
+_LANE_SALT = 0x5851F42D4C957F2D
+_MASK_64 = (1 << 64) - 1
+
+def _mix64(key):
+    '''splitmix64 finalizer on a Python integer.'''
 
-    graph : numpy array (adjacency matrix of current graph)'''
+    z = (key + _MIX_CONSTANTS[0]) & _MASK_64
+    z = ((z ^ (z >> 30)) * _MIX_CONSTANTS[1]) & _MASK_64
+    z = ((z ^ (z >> 27)) * _MIX_CONSTANTS[2]) & _MASK_64
+    return z ^ (z >> 31)
 
-    #making new object
-    graph = np.array(graph.tolist())
-    if np.count_nonzero(graph) == len(graph) * len(graph):
-        raise ValueError('Fully connected network: impossible to utilize constrained swapping MC method')
-    print(graph.shape)
-    i_1 = np.random.randint(0,len(graph))
-    j_1 = np.random.randint(0,len(graph))
-    i_2 = np.random.randint(0,len(graph))
-    j_2 = np.random.randint(0,len(graph))
+def _mix64_array(keys):
+    '''splitmix64 finalizer on an array of uint64 keys (wraps around exactly like _mix64).'''
 
-    while graph[i_1,j_1] == 0 or graph[i_2,j_2] == 0 or graph[i_1,j_2] != 0 or graph[i_2,j_1] != 0:
-        i_1 = np.random.randint(0,len(graph))
-        j_1 = np.random.randint(0,len(graph))
-        i_2 = np.random.randint(0,len(graph))
-        j_2 = np.random.randint(0,len(graph))
+    c_0, c_1, c_2 = [np.uint64(c) for c in _MIX_CONSTANTS]
+    z = keys + c_0
+    z = (z ^ (z >> np.uint64(30))) * c_1
+    z = (z ^ (z >> np.uint64(27))) * c_2
+    return z ^ (z >> np.uint64(31))
 
-    graph[i_1,j_1] = 0
-    graph[i_2,j_2] = 0
-    graph[i_1,j_2] = 1
-    graph[i_2,j_1] = 1
-    return graph
+def _edge_hashes(a, b):
+    '''Two independent 64 bit hashes of the undirected edge (a, b).'''
 
+    key = (min(a, b) << 32) | max(a, b)
+    return _mix64(key), _mix64(key ^ _LANE_SALT)
 
+def _fingerprint_lanes(edges):
+    '''Sums of the two edge hashes over all edges (with repeats), modulo 2^64.'''
 
+    edges = np.asarray(edges, dtype=np.uint64).reshape(-1, 2)
+    keys = (edges.min(axis=1) << np.uint64(32)) | edges.max(axis=1)
+    with np.errstate(over='ignore'):
+        return [int(_mix64_array(keys).sum(dtype=np.uint64)), int(_mix64_array(keys ^ np.uint64(_LANE_SALT)).sum(dtype=np.uint64))]
+
+def graph_fingerprint(graph):
+    '''Returns a 128 bit integer identifying the given graph (any representation accepted by swap_function) up to the order
+    of its edges. It is the sum of a hash of every edge, so it does not depend on how the edges are stored and can be updated
+    in O(1) when edges are swapped. Two different graphs share a fingerprint with negligible probability.'''
+
+    lanes = _fingerprint_lanes(_edge_array(graph)[0])
+    return (lanes[0] << 64) | lanes[1]
+
+class EdgeSwapGraph(object):
+    '''Edge-list representation of an undirected (multi)graph supporting degree-preserving double-edge swaps in place.
+    The edges are kept in an (m, 2) array, plus a dictionary from each connected pair of people to its multiplicity, so
+    that picking two edges uniformly, checking a proposed swap and applying or undoing it all take O(1) time.
+
+    Inputs
+    ------
 
+    edges : array of integers of shape (m, 2) (each row is a pair of connected people; self-edges and repeats allowed)
+    num_people : integer (number of people in the network)'''
 
+    def __init__(self, edges, num_people):
+        self.edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+        self.num_people = num_people
+        self._multiplicity = {}
+        for a, b in self.edges.tolist():
+            self._add((a, b) if a <= b else (b, a), 1)
+        self._lanes = _fingerprint_lanes(self.edges)
+        self.rejected_swaps = 0 #proposals rejected by swap so far
 
+    @classmethod
+    def from_adjacency(cls, graph):
+        '''Builds the edge representation of a dense or scipy.sparse adjacency matrix (entries are edge multiplicities, the
+        diagonal counts self-edges once each), an (m, 2) edge list, a CompactGraph or another EdgeSwapGraph.'''
 
+        edges, num_people = _edge_array(graph)
+        return cls(edges, num_people)
 
+    def _add(self, key, count):
+        count += self._multiplicity.get(key, 0)
+        if count:
+            self._multiplicity[key] = count
+        else:
+            del self._multiplicity[key]
 
+    def _replace(self, index, edge):
+        a, b = self.edges[index].tolist()
+        self._add((a, b) if a <= b else (b, a), -1)
+        self.edges[index] = edge
+        self._add(edge if edge[0] <= edge[1] else (edge[1], edge[0]), 1)
+        for lane, (old, new) in enumerate(zip(_edge_hashes(a, b), _edge_hashes(*edge))):
+            self._lanes[lane] = (self._lanes[lane] - old + new) & _MASK_64
 
+    def fingerprint(self):
+        '''Same value as graph_fingerprint(self), kept up to date in O(1) per swap.'''
 
+        return (self._lanes[0] << 64) | self._lanes[1]
+
+    def swap(self, rng, max_tries = None):
+        '''Replaces two uniformly chosen edges (a, b) and (c, d) by (a, d) and (c, b), rejecting proposals that would create a
+        self-edge or a repeated edge and drawing again. Returns a record of the swap that can be passed to undo. Raises a
+        ValueError if no valid swap is found within max_tries proposals (defaults to 100 per edge).'''
+
+        num_edges = len(self.edges)
+        if num_edges < 2:
+            raise ValueError('At least two edges are needed: impossible to utilize constrained swapping MC method')
+        if max_tries is None:
+            max_tries = 100 * num_edges
+
+        for attempt in range(max_tries):
+            k_1, k_2 = rng.integers(num_edges), rng.integers(2 * num_edges) #last bit of k_2 picks the orientation of edge 2
+            k_2, flip = divmod(int(k_2), 2)
+            if k_1 == k_2:
+                continue
+            a, b = self.edges[k_1].tolist()
+            c, d = self.edges[k_2].tolist()
+            if flip:
+                c, d = d, c
+            if a == d or c == b: #no self-edges
+                continue
+            new_1 = (a, d) if a < d else (d, a)
+            new_2 = (c, b) if c < b else (b, c)
+            if new_1 == new_2 or new_1 in self._multiplicity or new_2 in self._multiplicity: #no repeated edges
+                continue
+            old_1, old_2 = tuple(self.edges[k_1].tolist()), tuple(self.edges[k_2].tolist())
+            self._replace(k_1, new_1)
+            self._replace(k_2, new_2)
+            self.rejected_swaps += attempt
+            return int(k_1), k_2, old_1, old_2
+
+        self.rejected_swaps += max_tries
+        raise ValueError('No valid swap found: network may be too dense to utilize constrained swapping MC method')
+
+    def undo(self, swap):
+        '''Reverts a swap returned by swap (only valid if no other swap was made since).'''
+
+        k_1, k_2, old_1, old_2 = swap
+        self._replace(k_1, old_1)
+        self._replace(k_2, old_2)
+
+    def to_csr(self):
+        return edge_list_to_csr(self.edges, self.num_people)
+
+    def to_dense(self):
+        return self.to_csr().toarray()
+
+def swap_function(graph, rng = None, max_tries = None):
+    '''This function swaps two edges on a given graph, keeping every person's degree and the symmetry of the adjacency
+    matrix. Swaps that would create self-edges or repeated edges are rejected (see EdgeSwapGraph.swap).
+
+    Input
+    -----
 
+    graph : numpy array (adjacency matrix of current graph), scipy.sparse matrix, CompactGraph or (m, 2) edge list. The
+        swapped graph is returned in the same form (dense input gives a new numpy array)
+    rng : [optional] numpy.random.Generator or integer seed
+    max_tries : [optional] integer (number of proposals before giving up with a ValueError)'''
 
+    rng = np.random.default_rng(rng)
+    swap_graph = EdgeSwapGraph.from_adjacency(graph)
+    swap_graph.swap(rng, max_tries)
+    if sp.issparse(graph):
+        return swap_graph.to_csr()
+    if isinstance(graph, CompactGraph):
+        return CompactGraph(swap_graph.edges, swap_graph.num_people)
+    if _is_edge_list(graph):
+        return swap_graph.edges
+    return swap_graph.to_dense()
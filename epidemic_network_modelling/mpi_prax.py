@@ -1,8 +1,63 @@
-from mpi4py import MPI
+'''MPI backend for network_mc. Every rank runs its own independent Metropolis-Hastings chain starting from the same initial
+graph, which is generated once on rank 0 and broadcast to the other ranks. At the end the graph-visit counters of all
+chains (keyed by graph fingerprint) are combined with a reduction onto rank 0, which selects the most visited graphs
+exactly like network_mc does. Only those graphs are then rebuilt, by the ranks that visited them, and sent to rank 0.
 
-comm = MPI.COMM_WORLD
-rank = MPI.COMM_WORLD.Get_rank()
-size = MPI.COMM_WORLD.Get_size()
-name = MPI.Get_processor_name()
+Run locally with e.g.
 
-print("Hello world from rank {}".format(rank))
\ No newline at end of file
+    mpirun -n 4 python -m epidemic_network_modelling.mpi_prax
+
+If mpi4py is not installed, mpi_network_mc runs a single chain in the current process.'''
+
+import numpy as np
+import epidemic_network_modelling.epidemic_network_modelling as em
+
+try:
+    from mpi4py import MPI
+except ImportError: #fall back to a single chain
+    MPI = None
+
+
+def mpi_network_mc(degree_sequence, ages, choice_function, transmission_probability, recovery_probability,occupation_probability,graph_percent,num_its_network_mc = 10, num_its_sri_mc = 100, n_workers = 1, seed = None, comm = None):
+    '''Distributed version of network_mc: runs one chain of num_its_network_mc steps on every rank of comm (defaults to
+    MPI.COMM_WORLD) and returns the likely graphs of all chains pooled together on rank 0. The other ranks return None.
+
+    Inputs are the same as network_mc, plus
+
+    seed : [optional] integer (seed for the numpy.random.SeedSequence from which every rank gets an independent child stream)
+    comm : [optional] mpi4py communicator (ignored when mpi4py is not installed)'''
+
+    if comm is None and MPI is not None:
+        comm = MPI.COMM_WORLD
+    rank = comm.Get_rank() if comm is not None else 0
+    size = comm.Get_size() if comm is not None else 1
+
+    initial_graph = em.initial_graph_generator(degree_sequence, output = 'csr', rng = seed) if rank == 0 else None
+    entropy = np.random.SeedSequence(seed).entropy if rank == 0 else None
+    if comm is not None:
+        initial_graph = comm.bcast(initial_graph, root=0)
+        entropy = comm.bcast(entropy, root=0)
+    rng = np.random.default_rng(np.random.SeedSequence(entropy).spawn(size)[rank])
+
+    counter, history = em._network_chain(initial_graph, ages, choice_function, transmission_probability, recovery_probability, occupation_probability, num_its_network_mc, num_its_sri_mc, n_workers, rng)
+    if comm is None:
+        likely = em._most_visited(counter, graph_percent)
+        graphs = history.materialize(likely)
+        return [graphs[fingerprint] for fingerprint in likely]
+
+    #only the fingerprint counters travel; each rank then rebuilds the selected graphs it visited itself
+    counter = comm.reduce(counter, op=em._merge_visits, root=0)
+    likely = comm.bcast(em._most_visited(counter, graph_percent) if rank == 0 else None, root=0)
+    graphs = comm.reduce(history.materialize(likely), op=em._merge_graphs, root=0)
+
+    if rank != 0:
+        return None
+    return [graphs[fingerprint] for fingerprint in likely]
+
+
+if __name__ == '__main__':
+    deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+    ages = [30 for i in range(len(deg_seq))]
+    likely_graphs = mpi_network_mc(deg_seq, ages, em.min_epidemic_choice_fx, .3, .3, .8, .1, num_its_network_mc = 10, num_its_sri_mc = 50, seed = 0)
+    if likely_graphs is not None:
+        print("{} likely graphs found".format(len(likely_graphs)))
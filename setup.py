@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
 from setuptools import setup
 from distutils.core import setup
 from Cython.Build import cythonize
@@ -24,12 +25,17 @@ test_requirements = [
 
 
 
+if sys.platform == 'win32':
+    openmp_compile_args, openmp_link_args = ["/openmp"], []
+else:
+    openmp_compile_args, openmp_link_args = ["-O3", "-ffast-math", "-march=native", "-fopenmp"], ["-fopenmp"]
+
 ext_modules=[
     Extension("enm_cython",
               ["./epidemic_network_modelling/enm_cython.pyx"],
               # libraries=["m"],
-              extra_compile_args = ["-O3", "-ffast-math", "-march=native", "/openmp", "-fopenmp" ],
-              extra_link_args=['-fopenmp']
+              extra_compile_args = openmp_compile_args,
+              extra_link_args = openmp_link_args
               ) 
     ]
 
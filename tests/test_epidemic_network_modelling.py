@@ -9,7 +9,12 @@ Tests for `epidemic_network_modelling` module.
 """
 import epidemic_network_modelling.epidemic_network_modelling as em 
 import enm_cython as emc
+import os
+import pickle
 import numpy as np
+import pytest
+import warnings
+import scipy.sparse as sp
 
 def func(x):
 	return x + 1
@@ -26,6 +31,19 @@ def test_cython_omp():
 	correct_output = np.array([2 * i for i in range(100000)])
 	assert output[1234] == correct_output[1234]
 
+def test_initial_graph_generator():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,rng = 1)
+	assert np.allclose(graph,graph.T)
+	assert np.allclose(graph.sum(axis=1) + np.diag(graph),deg_seq)
+	assert np.allclose(em.initial_graph_generator(deg_seq,output = 'csr',rng = 1).toarray(),graph)
+	edges = em.initial_graph_generator(deg_seq,output = 'edges',rng = 1)
+	assert edges.shape == (sum(deg_seq) // 2, 2)
+	simple_graph = em.initial_graph_generator(deg_seq,output = 'csr',remove_self_loops = True,remove_multi_edges = True,rng = 1)
+	assert simple_graph.diagonal().sum() == 0 and simple_graph.max() == 1
+	with pytest.raises(ValueError):
+		em.initial_graph_generator([1,2,2])
+
 def test_sri_mc():
 	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
 	graph = em.initial_graph_generator(deg_seq)
@@ -43,6 +61,189 @@ def test_sri_mc():
 	# plt.show()
 	assert len(graph) == num_susceptible[5] + num_infected[5] + num_recovered[5]
 
+def test_sri_mc_sparse_matches_dense():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	rows, cols = np.nonzero(np.triu(np.asarray(graph)))
+	edge_list = np.transpose(np.vstack((rows, cols)))
+	ages = [30 for i in range(len(deg_seq))]
+	outputs = []
+	for adjacency in [graph, sp.csr_matrix(graph), edge_list]:
+		outputs.append(em.sri_mc(adjacency,ages,.5,.2,.8,num_its = 10,rng = np.random.default_rng(42)))
+	assert outputs[0] == outputs[1] == outputs[2]
+
+def test_sri_mc_seeded_runs_reproducible():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	ages = [30 for i in range(len(deg_seq))]
+	first = em.sri_mc(graph,ages,.5,.2,.8,num_its = 20,rng = np.random.default_rng(7))
+	second = em.sri_mc(graph,ages,.5,.2,.8,num_its = 20,rng = np.random.default_rng(7))
+	assert first == second
+	assert all(s + i + r == len(deg_seq) for s, i, r in zip(*first))
+
+def test_sri_mc_frontier_matches_sri_mc():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	ages = [30 for i in range(len(deg_seq))]
+	for seed in range(5):
+		expected = em.sri_mc(graph,ages,.5,.2,.8,num_its = 60,rng = seed,backend = 'numpy')
+		output = em.sri_mc_frontier(graph,ages,.5,.2,.8,num_its = 60,rng = seed)
+		assert output == expected
+
+def test_sri_mc_frontier_stops_early():
+	graph = np.array([[0,1,0],[1,0,0],[0,0,0]])
+	num_susceptible, num_infected, num_recovered = em.sri_mc_frontier(graph,[30,30,30],1,1,1,num_its = 10)
+	assert len(num_susceptible) == len(num_infected) == len(num_recovered) == 11
+	assert num_infected[10] == 0
+	assert (num_susceptible[10], num_recovered[10]) == (1, 2)
+
+def test_sri_mc_continuous():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	for method in ('next_reaction','tau_leap'):
+		num_susceptible, num_infected, num_recovered = map(np.array,em.sri_mc_continuous(graph,deg_seq,.5,.2,.8,num_its = 30,rng = 1,method = method))
+		assert len(num_susceptible) == 31 and np.all(num_susceptible + num_infected + num_recovered == len(deg_seq))
+		assert num_infected[0] == 1 and np.all(np.diff(num_susceptible) <= 0) and np.all(np.diff(num_recovered) >= 0)
+		assert em.sri_mc_continuous(graph,deg_seq,.5,.2,.8,num_its = 30,rng = 1,method = method)[0] == num_susceptible.tolist()
+		#a single contact infects within a day with the daily probability
+		rng = np.random.default_rng(0)
+		pair = em.prepare_graph(np.array([[0,1],[1,0]]))
+		infected = [em.sri_mc_continuous(pair,[30,30],.5,0,.8,num_its = 1,rng = rng,method = method)[0][1] == 0 for i in range(2000)]
+		assert abs(np.mean(infected) - .4) < .04
+		#nothing happens without transmission or recovery
+		assert em.sri_mc_continuous(graph,deg_seq,0,0,.8,num_its = 5,method = method) == ([30] * 6, [1] * 6, [0] * 6)
+	#the next-reaction cost does not grow with the number of days
+	num_susceptible, num_infected, num_recovered = em.sri_mc_continuous(graph,deg_seq,.5,.2,.8,num_its = 10**6,rng = 1)
+	assert num_infected[-1] == 0 and num_susceptible[30] == num_susceptible[-1]
+	with pytest.raises(ValueError):
+		em.sri_mc_continuous(graph,deg_seq,.5,.2,.8,method = 'daily')
+
+def test_sri_mc_ensemble():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	ages = [30 for i in range(len(deg_seq))]
+	num_susceptible, num_infected, num_recovered = em.sri_mc_ensemble(graph,ages,.5,.2,.8,num_its = 30,n_replicates = 50,rng = 3)
+	assert num_susceptible.shape == num_infected.shape == num_recovered.shape == (50, 31)
+	assert np.all(num_susceptible + num_infected + num_recovered == len(deg_seq))
+	assert np.all(num_infected[:,0] == 1)
+	assert len(np.unique(num_susceptible[:,30])) > 1 #replicates are independent
+
+def test_sri_mc_iter(tmp_path):
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	expected = em.sri_mc(graph,deg_seq,.5,.2,.8,num_its = 25,rng = 3,backend = 'numpy')
+	with em.TrajectorySink(str(tmp_path),chunk_size = 7) as sink:
+		days = list(em.sri_mc_iter(graph,deg_seq,.5,.2,.8,num_its = 25,rng = 3,sink = sink))
+	assert [list(counts) for counts in zip(*days)] == list(expected)
+	infection_time, recovery_time = em.read_trajectory(str(tmp_path),len(deg_seq))
+	num_susceptible, num_infected, num_recovered = expected
+	for day in range(26):
+		assert np.sum((infection_time >= 0) & (infection_time <= day)) == num_infected[day] + num_recovered[day]
+		assert np.sum((recovery_time >= 0) & (recovery_time <= day)) == num_recovered[day]
+	assert np.all(recovery_time[recovery_time >= 0] > infection_time[recovery_time >= 0])
+
+def test_csr_graph_files(tmp_path):
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	edges = em.initial_graph_generator(deg_seq,output = 'edges',rng = 0)
+	np.savetxt(str(tmp_path / 'edges.txt'),edges,fmt = '%d')
+	em.edge_file_to_csr_graph(str(tmp_path / 'edges.txt'),str(tmp_path / 'from_file'),chunk_size = 10)
+	em.save_csr_graph(edges,str(tmp_path / 'saved'))
+	expected = em.sri_mc(edges,deg_seq,.5,.2,.8,num_its = 25,rng = 3,backend = 'numpy')
+	for directory in ('from_file','saved'):
+		graph = em.load_csr_graph(str(tmp_path / directory))
+		assert not graph.indices.flags.writeable #read-only memory map, not a copy
+		assert em._contact_pattern(graph) is graph
+		assert (graph != em._contact_pattern(edges)).nnz == 0
+		assert em.sri_mc(graph,deg_seq,.5,.2,.8,num_its = 25,rng = 3,backend = 'numpy') == expected
+	graph, weights = em.load_csr_graph(str(tmp_path / 'saved'),return_weights = True)
+	assert weights.sum() == np.sum(edges[:,0] != edges[:,1]) * 2
+
+def test_init_distrib():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	mask = np.zeros(len(deg_seq),dtype = bool)
+	mask[[4,9]] = True
+	expected = em.sri_mc(graph,deg_seq,.5,.2,.8,init_distrib = [9,4],num_its = 30,rng = 2,backend = 'numpy')
+	assert expected[1][0] == 2
+	assert em.sri_mc(graph,deg_seq,.5,.2,.8,init_distrib = mask,num_its = 30,rng = 2,backend = 'numpy') == expected
+	assert em.sri_mc(graph,deg_seq,.5,.2,.8,init_distrib = mask.astype(int),num_its = 30,rng = 2,backend = 'numpy') == expected
+	assert em.sri_mc_frontier(graph,deg_seq,.5,.2,.8,init_distrib = mask,num_its = 30,rng = 2) == expected
+	assert em.sri_mc(graph,deg_seq,.5,.2,.8,init_distrib = mask,num_its = 30,rng = 2,backend = 'cython')[1][0] == 2
+	with pytest.raises(ValueError):
+		em.sri_mc(graph,deg_seq,.5,.2,.8,init_distrib = [40])
+
+def test_seeding_ensemble():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	contact_pattern = em.prepare_graph(em.initial_graph_generator(deg_seq,output = 'csr',rng = 0))
+	assert em._contact_pattern(contact_pattern) is contact_pattern
+	seed_sets = [[0],[4,9],np.arange(len(deg_seq)) < 5]
+	num_susceptible, num_infected, num_recovered = em.seeding_ensemble(contact_pattern,seed_sets,.5,.2,.8,num_its = 30,n_replicates = 3,rng = 1)
+	assert num_susceptible.shape == (3,3,31)
+	assert np.array_equal(num_infected[:,:,0],[[1,1,1],[2,2,2],[5,5,5]])
+	assert np.all(num_susceptible + num_infected + num_recovered == len(deg_seq))
+	batched = em.seeding_ensemble(contact_pattern,seed_sets,.5,.2,.8,num_its = 30,n_replicates = 3,rng = 1,max_rows = 4)
+	assert batched[0].shape == (3,3,31)
+	single, _, _ = em.seeding_ensemble(contact_pattern,[[4,9]],.5,.2,.8,num_its = 30,rng = 1)
+	assert np.array_equal(single[0],em.sri_mc_ensemble(contact_pattern,deg_seq,.5,.2,.8,init_distrib = [4,9],num_its = 30,n_replicates = 1,rng = 1)[0])
+
+def test_parameter_sweep(tmp_path):
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	grid = ([.1,.3,.5],[.2,.4],[.8,1])
+	results = em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,rng = 7,chunk_size = 5)
+	assert results.shape == (3 * 2 * 2 * 4,)
+	assert np.all(results['num_susceptible'] + results['num_infected'] + results['num_recovered'] == len(deg_seq))
+	assert np.array_equal(results['point'],np.repeat(np.arange(12),4))
+	assert np.array_equal(results,em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,rng = 7,chunk_size = 5,n_workers = 2))
+	path = str(tmp_path / 'sweep')
+	em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,rng = 7,chunk_size = 5,path = path)
+	os.remove(os.path.join(path,'points_000000005.npy')) #as if interrupted before the second chunk was saved
+	assert np.array_equal(results,em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,chunk_size = 5,path = path))
+	assert np.array_equal(results,em.read_sweep(path))
+	#numpy integers are saved like python ones, and resume the same sweep
+	assert np.array_equal(results,em.parameter_sweep(graph,*grid,num_its = np.int64(20),n_replicates = np.int32(4),rng = 7,chunk_size = np.int64(5),path = str(tmp_path / 'numpy')))
+	assert np.array_equal(results,em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,chunk_size = 5,path = str(tmp_path / 'numpy')))
+	with pytest.raises(ValueError):
+		em.parameter_sweep(graph,[.1],[.2],[.8],num_its = 20,n_replicates = 4,path = path)
+	#a saved sweep is only continued on the same network, seeding and susceptibilities
+	with pytest.raises(ValueError):
+		em.parameter_sweep(sp.csr_matrix((31,31)),*grid,num_its = 20,n_replicates = 4,chunk_size = 5,path = path)
+	with pytest.raises(ValueError):
+		em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,chunk_size = 5,path = path,init_distrib = [3,4,5])
+	with pytest.raises(ValueError):
+		em.parameter_sweep(graph,*grid,num_its = 20,n_replicates = 4,chunk_size = 5,path = path,susceptibility = np.full(31,.5))
+
+def test_compartment_models():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	susceptibility = np.linspace(.5,1.5,len(deg_seq))
+	assert em.model_mc(graph,em.sir_model(.5,.2,.8),num_its = 30,rng = 4,susceptibility = susceptibility) == em.sri_mc(graph,deg_seq,.5,.2,.8,num_its = 30,rng = 4,backend = 'numpy',susceptibility = susceptibility)
+	for model in (em.sis_model(.5,.2,.8),em.seir_model(.5,.3,.2,.8),em.sirs_model(.5,.2,.1,.8)):
+		counts = em.model_mc_ensemble(graph,model,num_its = 30,n_replicates = 5,rng = 1)
+		assert len(counts) == len(model.states)
+		assert np.all(sum(counts) == len(deg_seq))
+		assert counts[model.index(model.seed_state)][0,0] == 1
+		assert em.model_mc(graph,model,num_its = 30,rng = 1) == tuple(count[0].tolist() for count in em.model_mc_ensemble(graph,model,num_its = 30,n_replicates = 1,rng = 1))
+	seir = em.model_mc(graph,em.seir_model(.5,.3,.2,.8),num_its = 30,rng = 2)
+	assert seir[1][1] <= deg_seq[0] and seir[2][1] <= 1 #only contacts of the index case can be exposed on day one
+	with pytest.raises(ValueError):
+		em.CompartmentModel(('S','I'),[('S','X',.5,'I')])
+	model = em.sirs_model(.5,.2,.1,.8)
+	assert repr(em.CompartmentModel(**model.description())) == repr(model)
+
+def test_network_mc_model():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	ages = [30 for i in range(len(deg_seq))]
+	model = em.seir_model(.5,.3,.2,.8)
+	likely_graphs, stats = em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.2,num_its_network_mc = 8,num_its_sri_mc = 20,rng = 1,stats = True,model = model)
+	assert stats.steps == 8
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	expected = em.model_mc_ensemble(graph,model,num_its = 20,n_replicates = 10,rng = 3)[0][:,20].sum()
+	assert em._final_susceptible(graph,ages,.3,.3,.8,20,0,10,None,1,np.random.default_rng(3),model = model) == expected
+	with em.ProcessPoolExecutor(2) as executor:
+		sums = [em._parallel_final_susceptible([graph],0,.3,.3,.8,20,10,executor,2,np.random.default_rng(5),model = model) for i in range(2)]
+	assert sums[0] == sums[1]
+
 def test_network_mc():
     deg_seq = [2,2,3,5,6,4,2,5,3]
     ages = [42,23,37,19,12,13,98,14,43]
@@ -53,6 +254,101 @@ def test_network_mc():
     graph_percent = .06
     em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,transmission_prob,recovery_prob,occupation_prob,graph_percent,num_its_network_mc=11,num_its_sri_mc=100)
 
+def test_network_mc_stats():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	ages = [30 for i in range(len(deg_seq))]
+	steps = []
+	likely_graphs, stats = em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.2,num_its_network_mc = 12,num_its_sri_mc = 20,rng = 1,callback = lambda step, stats: steps.append(step))
+	assert steps == list(range(12))
+	assert stats.steps == 12 and 0 <= stats.accepted <= 12
+	assert stats.acceptance_rate == stats.accepted / 12.
+	assert set(stats.phase_time) == set(['initial_graph','swap','choice','bookkeeping','materialize'])
+	assert stats.simulated_days == 13 * 20 * 100 #the first step also simulates the initial graph
+	assert stats.simulated_node_days == stats.simulated_days * len(deg_seq)
+	assert stats.days_per_second > 0
+	without_stats = em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.2,num_its_network_mc = 12,num_its_sri_mc = 20,rng = 1)
+	assert all(np.array_equal(a, b) for a, b in zip(likely_graphs, without_stats))
+
+def test_network_mc_checkpoint(tmp_path):
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	ages = [30 for i in range(len(deg_seq))]
+	checkpoint = str(tmp_path / 'chain.npz')
+	expected = em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.3,num_its_network_mc = 30,num_its_sri_mc = 20,rng = 5)
+	def preempt(step, stats):
+		if step == 16:
+			raise KeyboardInterrupt
+	with pytest.raises(KeyboardInterrupt):
+		em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.3,num_its_network_mc = 30,num_its_sri_mc = 20,rng = 5,checkpoint = checkpoint,checkpoint_every = 7,callback = preempt)
+	assert int(np.load(checkpoint)['step']) == 14
+	size = os.path.getsize(checkpoint)
+	for log in ('.swaps','.visits'): #as if the next checkpoint was interrupted after writing to the logs
+		with open(checkpoint + log,'ab') as log_file:
+			log_file.write(b'partial record')
+	resumed = em.resume_network_mc(checkpoint,em.min_epidemic_choice_fx)
+	assert len(resumed) == len(expected)
+	assert all(np.array_equal(a, b) for a, b in zip(resumed, expected))
+	assert int(np.load(checkpoint)['step']) == 30
+	#the checkpoint itself does not grow with the steps, only the logs do
+	assert abs(os.path.getsize(checkpoint) - size) < 64 #only the length of the rng state text varies
+	#numpy numbers are saved like python ones
+	numpy_checkpoint = str(tmp_path / 'numpy.npz')
+	em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,np.float32(.3),.3,.8,.3,num_its_network_mc = np.int64(3),num_its_sri_mc = np.int64(5),rng = 5,checkpoint = numpy_checkpoint,
+		cache_scores = np.bool_(True),model = em.sir_model(np.float32(.3),.3,.8))
+	assert em.resume_network_mc(numpy_checkpoint,em.min_epidemic_choice_fx,num_its_network_mc = np.int64(5))
+	assert os.path.getsize(checkpoint + '.visits') % em._visit_record.itemsize == 0
+
+def test_network_mc_sequential(tmp_path):
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	ages = [30 for i in range(len(deg_seq))]
+	likely_graphs, stats = em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.3,num_its_network_mc = 12,num_its_sri_mc = 20,rng = 1,stats = True,sequential = True,batch_size = 5)
+	assert stats.simulated_days < 13 * 20 * 100 #the sequential test stops before all replicates
+	#the sequential settings are kept in the checkpoint
+	checkpoint = str(tmp_path / 'chain.npz')
+	expected = em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.3,num_its_network_mc = 20,num_its_sri_mc = 20,rng = 5,sequential = True,batch_size = 5)
+	em.network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.3,num_its_network_mc = 10,num_its_sri_mc = 20,rng = 5,checkpoint = checkpoint,sequential = True,batch_size = 5)
+	resumed = em.resume_network_mc(checkpoint,em.min_epidemic_choice_fx,num_its_network_mc = 20)
+	assert len(resumed) == len(expected)
+	assert all(np.array_equal(a, b) for a, b in zip(resumed, expected))
+	likely_graphs, diagnostics = em.multi_chain_network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.3,n_chains = 2,max_its_network_mc = 6,num_its_sri_mc = 20,check_every = 3,n_processes = 1,rng = 2,sequential = True,batch_size = 5)
+	assert diagnostics['steps'] == 6
+
+def test_chain_diagnostics():
+	rng = np.random.default_rng(0)
+	independent = rng.normal(size = (4,1000))
+	assert abs(em.r_hat(independent) - 1) < .01
+	assert em.effective_sample_size(independent) > 3000
+	assert em.r_hat(independent + np.arange(4)[:,None]) > 1.5
+	autocorrelated = np.zeros((4,1000))
+	for t in range(1,1000):
+		autocorrelated[:,t] = .9 * autocorrelated[:,t-1] + rng.normal(size = 4)
+	assert em.effective_sample_size(autocorrelated) < 500
+
+def test_multi_chain_network_mc():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	ages = [30 for i in range(len(deg_seq))]
+	likely_graphs, diagnostics = em.multi_chain_network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.2,n_chains = 3,max_its_network_mc = 40,num_its_sri_mc = 10,check_every = 20,r_hat_threshold = 100,min_ess = 1,rng = 3,n_processes = 1)
+	assert diagnostics['converged'] and diagnostics['steps'] == 20 #loose thresholds pass at the first check
+	assert diagnostics['traces'].shape == (3,20,len(em.CHAIN_STATISTICS))
+	assert set(diagnostics['r_hat']) == set(em.CHAIN_STATISTICS)
+	assert all(np.allclose(graph.sum(axis=1) + np.diag(graph),deg_seq) for graph in likely_graphs)
+	pooled_graphs, pooled = em.multi_chain_network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.2,n_chains = 3,max_its_network_mc = 40,num_its_sri_mc = 10,check_every = 20,r_hat_threshold = 100,min_ess = 1,rng = 3,n_processes = 3)
+	assert np.array_equal(pooled['traces'], diagnostics['traces'])
+
+def test_mpi_network_mc():
+	import epidemic_network_modelling.mpi_prax as mpi
+	deg_seq = [2,2,3,5,6,4,2,5,3]
+	ages = [42,23,37,19,12,13,98,14,43]
+	likely_graphs = mpi.mpi_network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.5,num_its_network_mc=4,num_its_sri_mc=20,seed=1)
+	assert len(likely_graphs) >= 1
+	mpi_module = mpi.MPI
+	mpi.MPI = None #as if mpi4py were not installed
+	try:
+		likely_graphs = mpi.mpi_network_mc(deg_seq,ages,em.min_epidemic_choice_fx,.3,.3,.8,.5,num_its_network_mc=4,num_its_sri_mc=20,seed=1)
+	finally:
+		mpi.MPI = mpi_module
+	assert len(likely_graphs) >= 1
+	assert likely_graphs[0].shape == (9, 9)
+
 def test_min_epidemic_choice_fx():
 	ages = [42,23,37]
 	current_graph = np.array([[0,1,1],[1,0,0],[1,0,0]])
@@ -64,18 +360,206 @@ def test_min_epidemic_choice_fx():
 	output_array = em.min_epidemic_choice_fx(candidate_graph,current_graph,ages,transmission_prob,recovery_prob,occupation_prob,num_its)
 	assert True == (np.allclose(candidate_graph,output_array))
 
+def test_min_epidemic_choice_fx_score_cache():
+	ages = [42,23,37]
+	current_graph = np.array([[0,1,1],[1,0,0],[1,0,0]])
+	candidate_graph = np.array([[0,1,0],[1,0,1],[0,1,0]])
+	score_cache = {}
+	em.min_epidemic_choice_fx(candidate_graph,current_graph,ages,.5,.5,.8,20,rng = 1,score_cache = score_cache)
+	assert set(score_cache) == set([em.graph_fingerprint(candidate_graph),em.graph_fingerprint(current_graph)])
+	score_cache[em.graph_fingerprint(current_graph)] = 1e-9 #cached score is used instead of simulating the current graph
+	for i in range(10):
+		assert em.min_epidemic_choice_fx(current_graph,candidate_graph,ages,.5,.5,.8,20,rng = i,score_cache = {em.graph_fingerprint(candidate_graph): 1e-9}) is current_graph
+
+def test_min_epidemic_choice_fx_common_random_numbers():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	same_graph = sp.csr_matrix(graph)
+	for i in range(10): #identical graphs under common random numbers always give a ratio of one
+		assert em.min_epidemic_choice_fx(same_graph,graph,deg_seq,.5,.2,.8,20,rng = i,n_replicates = 10,common_random_numbers = True) is same_graph
+
+def test_min_epidemic_choice_fx_sequential():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	same_graph = graph.copy()
+	stats = em.ChainStats()
+	#identical graphs under common random numbers give a ratio of exactly one, decided after the first batch
+	assert em.min_epidemic_choice_fx(same_graph,graph,deg_seq,.5,.2,.8,20,rng = 1,n_replicates = 100,common_random_numbers = True,stats = stats,sequential = True,batch_size = 5) is same_graph
+	assert stats.simulated_days == 2 * 20 * 5
+	star = np.zeros((31,31))
+	star[0,1:] = star[1:,0] = 1
+	empty = np.zeros((31,31))
+	empty[0,1] = empty[1,0] = 1
+	stats = em.ChainStats()
+	score_cache = {}
+	for i in range(5): #a star is clearly worse than a single edge
+		assert em.min_epidemic_choice_fx(star,empty,deg_seq,.9,.1,1,20,rng = i,n_replicates = 100,score_cache = score_cache,stats = stats,sequential = True) is empty
+	assert stats.simulated_days < 5 * 2 * 20 * 100
+	assert em.graph_fingerprint(star) in score_cache
+	#with nobody left susceptible on the current graph the candidate is accepted after the first batch
+	stats = em.ChainStats()
+	with warnings.catch_warnings():
+		warnings.simplefilter('error')
+		assert em.min_epidemic_choice_fx(star.copy(),star,deg_seq,1,1,1,10,rng = 0,n_replicates = 100,stats = stats,sequential = True) is not star
+	assert stats.simulated_days == 2 * 10 * 10
+
+def test_score_cache(tmp_path):
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	candidate = em.swap_function(graph,rng = 0)
+	path = str(tmp_path / 'scores.npz')
+	stats = em.ChainStats()
+	with em.ScoreCache(path = path) as cache:
+		for i in range(3): #both graphs are only simulated the first time
+			em.min_epidemic_choice_fx(candidate,graph,deg_seq,.5,.2,.8,20,rng = i,n_replicates = 10,stats = stats,result_cache = cache)
+		assert stats.simulated_days == 2 * 20 * 10 and len(cache) == 2 and cache.hits == 4
+		assert cache.misses == 2 #one per graph, although both the full and the sequential keys are looked up
+		parameters = em.score_parameters(deg_seq,.5,.2,.8,20)
+		score, variance = cache.get(em.graph_fingerprint(graph),parameters,10)
+		assert score == em._final_susceptible(graph,deg_seq,.5,.2,.8,20,0,10,None,1,np.random.default_rng(0)) and variance >= 0
+		assert cache.get(em.graph_fingerprint(graph),em.score_parameters(deg_seq,.5,.2,.8,21),10) is None
+		assert cache.get(em.graph_fingerprint(graph),parameters,20) is None
+	#a new cache starts warm from the file, a small one keeps the most recently used scores
+	warm = em.ScoreCache(max_entries = 1,path = path)
+	assert len(warm) == 1 and warm.get(em.graph_fingerprint(graph),parameters,10) == (score, variance)
+	stats = em.ChainStats()
+	em.min_epidemic_choice_fx(candidate,graph,deg_seq,.5,.2,.8,20,rng = 0,n_replicates = 10,stats = stats,result_cache = warm,sequential = True)
+	assert stats.simulated_days <= 20 * 10
+	#network_mc shares one cache over the chain and with later runs
+	cache = em.ScoreCache()
+	em.network_mc(deg_seq,deg_seq,em.min_epidemic_choice_fx,.5,.2,.8,.1,num_its_network_mc = 20,num_its_sri_mc = 20,rng = 3,result_cache = cache)
+	assert 1 < len(cache) <= 21 and cache.hits == 0
+	#the same run again finds the initial graph and first candidate (and then diverges, having used fewer random numbers)
+	em.network_mc(deg_seq,deg_seq,em.min_epidemic_choice_fx,.5,.2,.8,.1,num_its_network_mc = 20,num_its_sri_mc = 20,rng = 3,result_cache = cache)
+	assert cache.hits >= 2
+
+def test_min_epidemic_choice_fx_parallel():
+	ages = [42,23,37]
+	current_graph = np.array([[0,1,1],[1,0,0],[1,0,0]])
+	candidate_graph = np.array([[0,1,0],[1,0,1],[0,1,0]])
+	with em.ProcessPoolExecutor(2) as executor:
+		outputs = [em.min_epidemic_choice_fx(candidate_graph,current_graph,ages,1,1,.8,200,rng = 5,n_workers = 2,executor = executor) for i in range(2)]
+		sums = [em._parallel_final_susceptible([candidate_graph,current_graph],0,.5,.5,.8,20,10,executor,2,np.random.default_rng(5)) for i in range(2)]
+	assert np.allclose(candidate_graph,outputs[0]) and np.allclose(candidate_graph,outputs[1])
+	assert sums[0] == sums[1]
+
+def test_min_epidemic_choice_fx_parallel_susceptibility():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	candidate = em.swap_function(graph,rng = 0)
+	#a plain list is accepted by the worker processes like by the serial path
+	with em.ProcessPoolExecutor(2) as executor:
+		em.min_epidemic_choice_fx(candidate,graph,deg_seq,.5,.2,.8,10,rng = 0,n_replicates = 4,n_workers = 2,executor = executor,susceptibility = [1.0] * 31)
+		with pytest.raises(ValueError):
+			em.min_epidemic_choice_fx(candidate,graph,deg_seq,.5,.2,.8,10,rng = 0,n_replicates = 4,n_workers = 2,executor = executor,susceptibility = [1.0] * 30)
+	assert len(em.network_mc(deg_seq,deg_seq,em.min_epidemic_choice_fx,.5,.2,.8,.1,num_its_network_mc = 3,num_its_sri_mc = 10,n_workers = 2,rng = 0,susceptibility = [1.0] * 31)) == 1
+
 def test_age():
 	ages = [2,9,19,29,39,49,59,69]
 	transmission_prob = recovery_prob = .5
 	age_effects = np.array(em.age(ages,transmission_prob,recovery_prob))
 	assert True == (np.allclose(age_effects,np.array([.025,.0125,-.0125,-.0125,-.0125,-.0125,-.0125,.0125])))
 
+def test_age_vectorized():
+	ages = np.array([3,12,12.5,13,40,64,65,90])
+	age_effects = em.age(ages,1,1)
+	assert np.allclose(age_effects,[.10,.05,-.05,-.05,-.05,-.05,.05,.05])
+	assert np.allclose(em.age_susceptibility(ages),1 + age_effects)
+	assert em.age(np.full(10**6,30),.5,.5).shape == (10**6,)
+	for bad_ages in ([np.nan],[30,np.inf,5]):
+		with pytest.raises(ValueError):
+			em.age(bad_ages,1,1)
+
+def test_sri_mc_susceptibility():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	immune = np.zeros(len(deg_seq))
+	for backend in ['numpy','cython']:
+		num_susceptible,_,_ = em.sri_mc(graph,deg_seq,.9,.2,.9,num_its = 20,rng = 1,backend = backend,susceptibility = immune)
+		assert num_susceptible[20] == len(deg_seq) - 1
+	num_susceptible,_,_ = em.sri_mc_ensemble(graph,deg_seq,.9,.2,.9,num_its = 20,n_replicates = 5,rng = 1,susceptibility = immune)
+	assert np.all(num_susceptible[:,20] == len(deg_seq) - 1)
+	susceptibility = em.age_susceptibility(deg_seq)
+	expected = em.sri_mc(graph,deg_seq,.5,.2,.8,num_its = 30,rng = 2,backend = 'numpy',susceptibility = susceptibility)
+	assert em.sri_mc_frontier(graph,deg_seq,.5,.2,.8,num_its = 30,rng = 2,susceptibility = susceptibility) == expected
+	with pytest.raises(ValueError):
+		em.sri_mc(graph,deg_seq,.5,.2,.8,susceptibility = [1,1])
+
+def test_compact_graph():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	dense = em.initial_graph_generator(deg_seq,rng = 0)
+	compact = em.initial_graph_generator(deg_seq,output = 'compact',rng = 0)
+	assert compact.rows.dtype == np.uint8 and compact.counts.dtype == np.uint8 and compact.nbytes < dense.nbytes / 10
+	assert np.array_equal(compact.to_dense(),dense) and compact == em.CompactGraph.from_adjacency(dense)
+	assert np.array_equal(compact.degrees(),deg_seq)
+	assert em.graph_fingerprint(compact) == em.graph_fingerprint(dense)
+	assert pickle.loads(pickle.dumps(compact)) == compact
+	with pytest.raises(AttributeError):
+		compact.extra = 1
+	#simulations read it like the dense matrix
+	assert em.sri_mc(compact,deg_seq,.5,.3,.8,num_its = 20,rng = 2,backend = 'numpy') == em.sri_mc(dense,deg_seq,.5,.3,.8,num_its = 20,rng = 2,backend = 'numpy')
+	assert em._is_contact_pattern(compact.contact_pattern())
+	assert (compact.contact_pattern() != em._contact_pattern(dense)).nnz == 0
+	#swaps keep the form and the degrees
+	swapped = em.swap_function(compact,rng = 1)
+	assert isinstance(swapped,em.CompactGraph) and np.array_equal(swapped.degrees(),compact.degrees())
+	assert np.array_equal(swapped.to_dense(),em.swap_function(dense,rng = 1))
+	#network_mc can start from it and return it
+	simple = em.initial_graph_generator(deg_seq,output = 'compact',remove_self_loops = True,remove_multi_edges = True,rng = 0)
+	graphs = em.network_mc(simple,deg_seq,em.min_epidemic_choice_fx,.3,.3,.8,.1,num_its_network_mc = 5,num_its_sri_mc = 10,rng = 0,output = 'compact')
+	assert all(isinstance(graph,em.CompactGraph) and np.array_equal(graph.degrees(),simple.degrees()) for graph in graphs)
+	assert em.network_mc(deg_seq,deg_seq,em.min_epidemic_choice_fx,.3,.3,.8,.1,num_its_network_mc = 5,num_its_sri_mc = 10,rng = 0,output = 'compact')[0] == em.CompactGraph.from_adjacency(em.network_mc(deg_seq,deg_seq,em.min_epidemic_choice_fx,.3,.3,.8,.1,num_its_network_mc = 5,num_its_sri_mc = 10,rng = 0)[0])
+
+def test_two_edge_list():
+	#a 2 x 2 array is an adjacency matrix only if it is symmetric
+	num_susceptible, num_infected, num_recovered = em.sri_mc(np.array([[0,5],[3,4]]),[30] * 6,1,0,1,num_its = 2,rng = 0)
+	assert num_susceptible[0] + num_infected[0] + num_recovered[0] == 6 and num_infected == [1,2,2]
+	assert em.sri_mc(np.array([[0,1],[1,0]]),[30,30],1,0,1,num_its = 2,rng = 0) == ([1,0,0],[1,2,2],[0,0,0])
+	swapped = em.swap_function(np.array([[0,1],[2,3]]),rng = 0)
+	assert swapped.shape == (2,2) and sorted(np.bincount(swapped.ravel(),minlength = 4)) == [1,1,1,1]
+
 def test_swap_function():
 	input_graph = np.array([[0,1],[1,0]])
-	new_graph = em.swap_function(input_graph) 
-	assert True == (np.allclose(new_graph,np.array([[1,0],[0,1]])))
+	with pytest.raises(ValueError): #a single edge cannot be swapped without creating self-edges
+		em.swap_function(input_graph)
+	input_graph = np.array([[0,1,0,0],[1,0,0,0],[0,0,0,1],[0,0,1,0]])
+	new_graph = em.swap_function(input_graph,rng = 0)
+	assert np.allclose(new_graph,new_graph.T)
+	assert np.allclose(new_graph.sum(axis=0),input_graph.sum(axis=0))
+	assert np.all(np.diag(new_graph) == 0)
 	assert False == np.allclose(new_graph,input_graph)
 
+def test_graph_fingerprint():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	swap_graph = em.EdgeSwapGraph.from_adjacency(graph)
+	fingerprint = em.graph_fingerprint(graph)
+	assert swap_graph.fingerprint() == fingerprint == em.graph_fingerprint(sp.csr_matrix(graph))
+	assert em.graph_fingerprint(swap_graph.edges[::-1,::-1]) == fingerprint
+	rng = np.random.default_rng(1)
+	swap = swap_graph.swap(rng)
+	assert swap_graph.fingerprint() != fingerprint
+	assert swap_graph.fingerprint() == em.graph_fingerprint(swap_graph.to_dense())
+	swap_graph.undo(swap)
+	assert swap_graph.fingerprint() == fingerprint
+
+def test_edge_swap_graph():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq)
+	swap_graph = em.EdgeSwapGraph.from_adjacency(graph)
+	rng = np.random.default_rng(1)
+	for i in range(200):
+		swap = swap_graph.swap(rng)
+		if i % 3 == 0:
+			swap_graph.undo(swap)
+	new_graph = swap_graph.to_dense()
+	assert np.allclose(new_graph,new_graph.T)
+	assert np.allclose(new_graph.sum(axis=1) + np.diag(new_graph),deg_seq)
+	assert np.all(np.diag(new_graph) <= np.diag(graph))
+	sparse_graph = em.swap_function(sp.csr_matrix(graph),rng = 2)
+	assert sp.issparse(sparse_graph)
+	assert np.allclose(sparse_graph.toarray().sum(axis=1) + sparse_graph.diagonal(),deg_seq)
+
 def test_cython_sri_mc():
 	graph = np.array([[1.0,1],[1,2]])
 	transmission_prob = 0.5
@@ -85,4 +569,24 @@ def test_cython_sri_mc():
 	ages = np.array([2,6,4,23,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3],ndmin=2)
 	num_susceptible, num_infected, num_recovered =  emc.cython_wrapper_sri_mc(graph,ages,transmission_prob,recovery_prob,occupation_prob)
 	print(num_susceptible)
-	assert 3 == 3
\ No newline at end of file
+	assert 3 == 3
+
+def test_cython_kernel_matches_numpy():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	graph = em.initial_graph_generator(deg_seq,output = 'csr',rng = 0)
+	ages = [30 for i in range(len(deg_seq))]
+	first = em.sri_mc(graph,ages,.5,.2,.8,num_its = 30,rng = 4,backend = 'cython')
+	assert first == em.sri_mc(graph,ages,.5,.2,.8,num_its = 30,rng = 4,backend = 'cython')
+	assert all(s + i + r == len(deg_seq) for s, i, r in zip(*first))
+	final_cython = np.mean([em.sri_mc(graph,ages,.3,.2,.8,num_its = 30,rng = i,backend = 'cython')[0][30] for i in range(400)])
+	final_numpy = np.mean([em.sri_mc(graph,ages,.3,.2,.8,num_its = 30,rng = i,backend = 'numpy')[0][30] for i in range(400)])
+	assert abs(final_cython - final_numpy) < 2
+
+def test_sri_mc_int64_indices():
+	deg_seq = [3,6,4,12,7,4,9,13,15,16,2,2,5,4,2,6,7,8,6,4,2,5,8,5,9,10,3,2,3,3,3]
+	pattern = em.prepare_graph(em.initial_graph_generator(deg_seq,output = 'csr',rng = 0))
+	wide = pattern.copy() #as loaded from a graph with more than 2**31 contacts
+	wide.indptr, wide.indices = pattern.indptr.astype(np.int64), pattern.indices.astype(np.int64)
+	assert em.sri_mc(wide,deg_seq,.5,.2,.8,num_its = 20,rng = 1) == em.sri_mc(pattern,deg_seq,.5,.2,.8,num_its = 20,rng = 1,backend = 'numpy')
+	with pytest.raises(ValueError):
+		em.sri_mc(wide,deg_seq,.5,.2,.8,num_its = 20,rng = 1,backend = 'cython')